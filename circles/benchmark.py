@@ -0,0 +1,232 @@
+#!/usr/bin/python3
+
+import os
+import json
+import time
+import random
+import hashlib
+import argparse
+import tempfile
+import multiprocessing
+import numpy as np
+
+import render
+
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden.json')
+
+
+def generate(n, seed=0):
+    """Returns deterministic funders and users lists in the format of the
+    render.py inputs that pack into about n circles
+
+    Asks are mostly small with a long tail and donations are a few orders
+    of magnitude larger, roughly like the real history.
+
+    """
+
+    rnd = random.Random(seed)
+
+    users = [[
+        'user{}'.format(i),
+        max(1, round(rnd.lognormvariate(3, 1))),
+        'target{}'.format(rnd.randrange(100)),
+        'description {}'.format(i),
+    ] for i in range(n * 9 // 10)]
+
+    funders = []
+    total = sum(u[1] for u in users)
+    while total > 0:
+        amount = max(1, round(rnd.lognormvariate(6, 1.5)))
+        funders.append(['funder{}'.format(len(funders)), amount])
+        total -= amount
+
+    return funders, users
+
+
+def overlaps(circles):
+    """Counts the pairs of circles that overlap by more than EPSILON"""
+
+    grid = render.Grid()
+    coords = circles.view()
+    count = 0
+
+    for c in circles:
+        near = list(grid.get_indices(c))
+        if near:
+            o = coords[near]
+            d = np.sqrt((o[:, 0] - c[0])**2 +
+                        (o[:, 1] - c[1])**2) + render.EPSILON
+            count += int(np.count_nonzero(d < o[:, 2] + c[2]))
+        grid.add_circle(c)
+
+    return count
+
+
+def fingerprint(circles):
+    return hashlib.sha256(
+        np.ascontiguousarray(circles.columns(), '<f8').tobytes()).hexdigest()
+
+
+def measure(n, seed=0, front=True):
+    """Packs, checks and renders about n circles and returns the timings,
+    counts, peak memory and layout hash
+
+    """
+
+    funders, users = generate(n, seed)
+    data = list(render.arrange(funders, users))
+    state = {}
+    stats = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+
+        start = time.perf_counter()
+        circles = render.calculate(data, front, state, stats=stats)
+        packed = time.perf_counter()
+
+        size = 2 * max(render._distance(c) + c[2] for c in circles)
+        render.render(circles, data, size)
+        rendered = time.perf_counter()
+
+        # the nightly refresh: nothing new, so load the cache and render
+        render._save_layout('circles.bin', state)
+        cached = time.perf_counter()
+        render.run(funders, users, front=front)
+        finished = time.perf_counter()
+
+    return {
+        'size': n,
+        'seed': seed,
+        'front': front,
+        'circles': len(circles),
+        'seconds': dict(
+            stats['seconds'],
+            calculate=packed - start,
+            render=rendered - packed,
+            run=finished - cached,
+        ),
+        'circles_per_second': (len(circles) - 2) / (packed - start),
+        'counts': stats['counts'],
+        'memory': render._peak_memory(),
+        'overlaps': overlaps(circles),
+        'hash': fingerprint(circles),
+    }
+
+
+def compare(old, new):
+    """Prints how the results of two runs differ for the sizes in both"""
+
+    before = {(r['size'], r['seed'], r['front']): r for r in old}
+
+    for r in new:
+        o = before.get((r['size'], r['seed'], r['front']))
+        if o is None:
+            continue
+
+        print('{:>8} {:>6.2f}x speed {:>6.2f}x memory  layout {}'.format(
+            r['size'],
+            r['circles_per_second'] / o['circles_per_second'],
+            r['memory'] / o['memory'],
+            'same' if r['hash'] == o['hash'] else 'CHANGED',
+        ))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description=
+        """Benchmark for packing and rendering circles on synthetic data of several sizes""",
+    )
+
+    parser.add_argument(
+        '-n',
+        '--sizes',
+        help='approximate numbers of circles to pack',
+        type=int,
+        nargs='+',
+        default=[1000, 10000, 100000],
+    )
+
+    parser.add_argument(
+        '--seed',
+        help='seed for the synthetic data',
+        type=int,
+        default=0,
+    )
+
+    parser.add_argument(
+        '-e',
+        '--exact',
+        help='consider every pair of circles (slow beyond a few thousand)',
+        action='store_true',
+    )
+
+    parser.add_argument(
+        '-o',
+        '--output',
+        help='file to save the results to as JSON',
+        default='benchmark.json',
+    )
+
+    parser.add_argument(
+        '-c',
+        '--compare',
+        help='results of an earlier run to compare against',
+    )
+
+    parser.add_argument(
+        '-u',
+        '--update',
+        help='store the layout hashes as the golden ones',
+        action='store_true',
+    )
+
+    args = parser.parse_args()
+
+    try:
+        with open(GOLDEN) as fd:
+            golden = json.load(fd)
+    except OSError:
+        golden = {}
+
+    results = []
+    for n in args.sizes:
+        # a fresh process for every size so that peak memory is its own
+        with multiprocessing.Pool(1) as pool:
+            result = pool.apply(measure, (n, args.seed, not args.exact))
+
+        key = '{}-{}-{}'.format('exact' if args.exact else 'front', n,
+                                args.seed)
+        if args.update:
+            golden[key] = result['hash']
+        result['golden'] = golden.get(key)
+        results.append(result)
+
+        if result['golden'] is None:
+            check = 'missing'
+        elif result['golden'] == result['hash']:
+            check = 'ok'
+        else:
+            check = 'MISMATCH'
+
+        print('{:>8} circles {:>8.2f}s {:>8.0f}/s {:>8.1f} MB  '
+              'overlaps {}  golden {}'.format(
+                  result['circles'],
+                  result['seconds']['calculate'],
+                  result['circles_per_second'],
+                  result['memory'],
+                  result['overlaps'],
+                  check,
+              ))
+
+    with open(args.output, 'w') as fd:
+        json.dump(results, fd, indent=2)
+
+    if args.update:
+        with open(GOLDEN, 'w') as fd:
+            json.dump(golden, fd, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as fd:
+            compare(json.load(fd), results)
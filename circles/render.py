@@ -1,15 +1,32 @@
 #!/usr/bin/python3
 
+import array
+import bisect
+import gzip
 import html
 import json
 import math
-import bisect
+import os
+import re
+import struct
+import sys
+import time
+import zlib
+import hashlib
+import multiprocessing
+import itertools
+import resource
 import argparse
-import drawSvg as draw
+import numpy as np
 
+from multiprocessing import shared_memory
 from tqdm import tqdm
 
 EPSILON = 1e-4
+MAGIC = b'CIRCLES\x00'
+
+# funders, users and highlighted users
+COLORS = ['#3b3b3b', '#84ab3f', '#ffff00']
 
 
 def _distance(p1, p2=(0, 0)):
@@ -20,153 +37,742 @@ def _radius(area):
     return math.sqrt(abs(area) / math.pi)
 
 
-class Grid:
-    """Stores circles in a grid and return all circles that are relevant
-    to a specific point
+def _peak_memory():
+    """Returns the peak resident memory of the process so far in MB"""
+
+    # ru_maxrss is in kilobytes on Linux but in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def _squared(x):
+    # x ** 2 on floats goes through libm's pow, which can round the last
+    # bit differently than x * x; float_power takes the same route so
+    # array results match the scalar ones exactly
+    return np.float_power(x, 2)
+
+
+class _Array:
+    """Numpy array that grows along its first axis as rows are added"""
+
+    def __init__(self, dtype, *shape):
+        self.data = np.empty((16, ) + shape, dtype)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def extend(self, rows):
+        rows = np.asarray(rows, self.data.dtype)
+        while self.size + len(rows) > len(self.data):
+            self.data = np.concatenate([self.data, np.empty_like(self.data)])
+        self.data[self.size:self.size + len(rows)] = rows
+        self.size += len(rows)
+
+    def replace(self, rows):
+        self.size = 0
+        self.extend(rows)
+
+    def view(self):
+        return self.data[:self.size]
+
+
+class Circles:
+    """Stores circles as contiguous columns of x, y and r that grow as
+    circles are added, and hands single circles out as (x, y, r) tuples
+
+    The columns can also be an existing (e.g. memory mapped) array, which
+    is only copied once more circles are added to it.
 
     """
 
-    SIZE = 8
+    def __init__(self, circles=[], columns=None):
+        self.data = np.empty((3, 16)) if columns is None else columns
+        self.size = 0 if columns is None else columns.shape[1]
+        self.extend(circles)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, k):
+        if k < 0:
+            k += self.size
+        if not 0 <= k < self.size:
+            raise IndexError(k)
+        return tuple(self.data[:, k].tolist())
+
+    def __iter__(self):
+        # a chunk at a time, so that iterating never copies everything
+        for start in range(0, self.size, 4096):
+            yield from map(tuple, self.view()[start:start + 4096].tolist())
+
+    def append(self, circle):
+        self.extend([circle])
+        return self.size - 1
+
+    def extend(self, circles):
+        if isinstance(circles, Circles):
+            circles = circles.view()
+        rows = np.asarray(circles, float).reshape(-1, 3)
+        if not len(rows):
+            return
+
+        capacity = self.data.shape[1]
+        while self.size + len(rows) > capacity:
+            capacity = max(capacity * 2, 16)
+        if capacity > self.data.shape[1]:
+            data = np.empty((3, capacity))
+            data[:, :self.size] = self.data[:, :self.size]
+            self.data = data
+
+        self.data[:, self.size:self.size + len(rows)] = rows.T
+        self.size += len(rows)
+
+    def columns(self):
+        return self.data[:, :self.size]
+
+    def view(self):
+        """Returns the circles as rows of x, y and r without copying"""
+
+        return self.data[:, :self.size].T
+
+
+class Grid:
+    """Stores circles in a sparse grid of squares and returns all circles
+    that are relevant to a specific point
+
+    Only squares that hold circles are stored, so memory follows the
+    number of circles rather than the extent of the packing. The square
+    size follows the mean radius and everything is rehashed whenever the
+    two drift apart by more than a factor of two. The circles themselves
+    are kept in a Circles store and squares only hold their indices.
+
+    """
 
     def __init__(self, circles=[]):
-        self.grid = [[[] for _ in range(4)] for _ in range(4)]
+        self.squares = {}
+        self.size = 0
+        self.total = 0
 
-        self.circles = []
+        self.circles = Circles()
 
         for c in circles:
             self.add_circle(c)
 
     def add_circle(self, circle):
-        while math.ceil((max(abs(circle[0]), abs(circle[1])) + circle[2]) /
-                        Grid.SIZE) >= int(len(self.grid) / 2):
-            self.grid = [
-                [[] for _ in range(len(self.grid[0]) * 2)]
-                for _ in range(int(len(self.grid) / 2))
-            ] + [[[] for _ in range(int(len(self.grid[0]) / 2))] + self.grid[j]
-                 + [[] for _ in range(int(len(self.grid[0]) / 2))]
-                 for j in range(int(len(self.grid)))
-                 ] + [[[] for _ in range(len(self.grid) * 2)]
-                      for _ in range(int(len(self.grid) / 2))]
-
-        for j, i in self._get_squares(circle):
-            self.grid[j][i].append(circle)
-        self.circles.append(circle)
+        """Adds the circle and returns its index"""
+
+        k = self.circles.append(circle)
+        self.total += circle[2]
+
+        mean = self.total / len(self.circles)
+        if not mean <= self.size <= mean * 4:
+            self.size = mean * 2
+            self.squares = {}
+            for i, c in enumerate(self.circles):
+                for key in self._get_squares(c):
+                    self.squares.setdefault(key, []).append(i)
+        else:
+            for key in self._get_squares(circle):
+                self.squares.setdefault(key, []).append(k)
+
+        return k
 
     def get_circles(self, circle):
-        seen = set()
-        for j, i in self._get_squares(circle):
-            if j < len(self.grid) and i < len(self.grid[0]):
-                for c in self.grid[j][i]:
-                    if c in seen:
-                        continue
-                    seen.add((j, i))
-                    yield c
+        for k in self.get_indices(circle):
+            yield self.circles[k]
+
+    def get_cell(self, point):
+        """Returns the indices of the circles in the square that contains
+        the given point
+
+        """
+
+        if not self.size:
+            return []
+
+        return self.squares.get((
+            math.floor(point[0] / self.size),
+            math.floor(point[1] / self.size),
+        ), [])
+
+    def get_indices(self, circle):
+        """Returns the indices of all circles relevant to the given one,
+        each of them once and in no particular order
+
+        """
+
+        indices = set()
+        if not self.size:
+            return indices
+
+        # looking up a few empty corner squares is cheaper than working
+        # out which squares the circle reaches into
+        x, y, r = circle
+        for j in range(
+                math.floor((x - r) / self.size),
+                math.floor((x + r) / self.size) + 1,
+        ):
+            for i in range(
+                    math.floor((y - r) / self.size),
+                    math.floor((y + r) / self.size) + 1,
+            ):
+                near = self.squares.get((j, i))
+                if near:
+                    indices.update(near)
+        return indices
 
     def _get_squares(self, circle):
+        x, y, r = circle
+
         for j in range(
-                int(
-                    math.floor((circle[0] - circle[2]) / Grid.SIZE) +
-                    len(self.grid) / 2),
-                int(
-                    math.ceil((circle[0] + circle[2]) / Grid.SIZE) +
-                    len(self.grid) / 2),
+                math.floor((x - r) / self.size),
+                math.floor((x + r) / self.size) + 1,
         ):
+            dx = max(j * self.size - x, 0, x - (j + 1) * self.size)
             for i in range(
-                    int(
-                        math.floor((circle[1] - circle[2]) / Grid.SIZE) +
-                        len(self.grid[0]) / 2),
-                    int(
-                        math.ceil((circle[1] + circle[2]) / Grid.SIZE) +
-                        len(self.grid[0]) / 2),
+                    math.floor((y - r) / self.size),
+                    math.floor((y + r) / self.size) + 1,
             ):
-                if _distance(circle, (
-                        (j - len(self.grid) / 2) * Grid.SIZE,
-                        (i - len(self.grid[0]) / 2) * Grid.SIZE,
-                )) <= circle[2] + (Grid.SIZE * 2):
+                dy = max(i * self.size - y, 0, y - (i + 1) * self.size)
+
+                # only squares that the circle actually reaches into
+                if dx**2 + dy**2 <= (r + EPSILON)**2:
                     yield (j, i)
 
 
 class Proximities:
-    """Stores distances between circles (edge to edge) and returns pairs
-    that are less than a given distance
+    """Stores distances between nearby circles (edge to edge) and returns
+    pairs that are less than a given distance
+
+    Neighbors are looked up through a grid, so only pairs within reach
+    are kept and larger distances are scanned for on demand. Circles
+    that are buried so deeply that not even a circle of the minimum
+    radius could touch them are dropped, since every position they
+    could propose would collide anyway.
+
+    The same goes for larger circles, which can't reach into the gaps
+    that smaller ones still fit into, so circles are buried separately
+    for each of a few tiers of radii, doubling from the minimum up to
+    half the reach. A circle buried for one tier is for every larger one
+    too, and pairs are kept and scanned for among the living circles of
+    the tier of the radius asked for, which mostly lie along the outside
+    of the packing.
 
     """
 
-    def __init__(self, circles=[]):
-        self.circles = {}
-        self.proximities = []
+    def __init__(self, circles=[], minimum=0, reach=0, pool=None):
+        self.grid = Grid()
+        self.circles = self.grid.circles
+        self.minimum = minimum
+        self.reach = reach
+        self.pool = pool
+        self.extent = 0
+
+        self.tiers = [minimum]
+        while minimum and self.tiers[-1] * 4 <= reach:
+            self.tiers.append(self.tiers[-1] * 2)
+
+        self.alive = _Array(bool, len(self.tiers))
+        self.keys = [_Array(np.int64) for _ in self.tiers]
+        self.gaps = [_Array(float) for _ in self.tiers]
+        self.dirty = [False] * len(self.tiers)
 
         for c in circles:
             self.add_circle(c)
 
     def add_circle(self, c2):
-        for c1 in self.circles:
-            bisect.insort(
-                self.proximities,
-                (max(0,
-                     _distance(c1, c2) - c1[2] - c2[2]), c1, c2),
-            )
-        self.circles[c2] = len(self.circles)
+        j = self.grid.add_circle(c2)
+        self.alive.extend([[True] * len(self.tiers)])
+        self.extent = max(self.extent, _distance(c2) + c2[2])
+
+        alive = self.alive.view()
+        near, gaps = _neighbors(self.grid, alive[:, 0], j, self.reach)
+        for t in range(len(self.tiers)):
+            keep = alive[near, t]
+            if keep.any():
+                self.keys[t].extend((near[keep] << 32) | j)
+                self.gaps[t].extend(gaps[keep])
+                self.dirty[t] = True
+
+        self._bury(j)
+
+    def __len__(self):
+        """Returns the number of pairs kept for the smallest radii"""
+
+        return len(self.keys[0])
+
+    def propose(self, radius, target=(0, 0), within=math.inf):
+        return _propose_batch(radius, self, target, within)
 
     def get_circles(self, distance):
-        return sorted(
-            [
-                x[1:] for x in self.proximities[:bisect.bisect_right(
-                    self.proximities,
-                    (distance + EPSILON, None, None),
-                )]
-            ],
-            key=lambda x: (self.circles[x[0]], self.circles[x[1]]),
-        )
+        return [(self.circles[i], self.circles[j])
+                for i, j in zip(*(x.tolist()
+                                  for x in self.get_pairs(distance)))]
+
+    def get_pairs(self, distance, target=(0, 0), within=math.inf):
+        """Returns the indices of both circles of each pair, ordered by the
+        first and then by the second index, leaving out the pairs with a
+        circle whose edge is further than within from the target
+
+        """
+
+        limit = distance + EPSILON
+
+        # the pairs are for placing a circle of half the distance, so
+        # any circle buried for its tier would make it collide
+        t = max(0, bisect.bisect_right(self.tiers, distance / 2) - 1)
+        alive = near = self.alive.view()[:, t]
+
+        if within < math.inf:
+            indices = np.flatnonzero(alive)
+            c = self.circles.view()[indices]
+            far = np.sqrt(
+                _squared(c[:, 0] - target[0]) +
+                _squared(c[:, 1] - target[1])) - c[:, 2] > within
+            near = alive.copy()
+            near[indices[far]] = False
+
+        if limit > self.reach:
+            if self.pool:
+                pairs = self.pool.scan(self.circles, near, limit)
+            else:
+                pairs = _scan(self.grid, near, np.flatnonzero(near), limit)
+            return np.array(pairs, np.int64).reshape(-1, 2).T
+
+        # keys encode (i, j) so sorting them once after new pairs came in
+        # gives the same order as sorting by both indices
+        if self.dirty[t]:
+            keys = self.keys[t].view()
+            keep = alive[keys >> 32] & alive[keys & 0xffffffff]
+            order = np.argsort(keys[keep], kind='stable')
+            self.keys[t].replace(keys[keep][order])
+            self.gaps[t].replace(self.gaps[t].view()[keep][order])
+            self.dirty[t] = False
+
+        keys = self.keys[t].view()
+        keep = self.gaps[t].view() <= limit
+        if near is not alive:
+            keep &= near[keys >> 32] & near[keys & 0xffffffff]
+        keys = keys[keep]
+        return keys >> 32, keys & 0xffffffff
+
+    def _bury(self, k):
+        if not self.minimum:
+            return
+
+        x, y, r = self.circles[k]
+        alive = self.alive.data
+        near = np.fromiter(
+            self.grid.get_indices((x, y, r + self.tiers[-1] * 2)), np.int64)
+        near = near[alive[near, 0]]
+        c = self.circles.view()[near]
+        gaps = np.sqrt(_squared(c[:, 0] - x) + _squared(c[:, 1] - y)) - c[:, 2] - r
+
+        for i, gap in zip(near.tolist(), gaps.tolist()):
+            # k can only have closed the last way in for the circles of
+            # the tiers that fit between the two
+            tiers = [
+                t for t, radius in enumerate(self.tiers)
+                if alive[i, t] and gap < radius * 2
+            ]
+            t = self._buried(i, tiers) if tiers else None
+            if t is not None:
+                alive[i, t:] = False
+                self.dirty[t:] = [True] * (len(self.tiers) - t)
+
+    def _buried(self, k, tiers):
+        """Returns the first of the given tiers for which every circle that
+        touches circle k would collide with one of its neighbors, or None
+        if there is none
+
+        """
+
+        x0, y0, r0 = self.circles[k]
+        near = [
+            i for i in self.grid.get_indices((
+                x0, y0, r0 + self.tiers[tiers[-1]] * 2)) if i != k
+        ]
+        c = self.circles.view()[near]
+        d = np.sqrt(_squared(c[:, 0] - x0) + _squared(c[:, 1] - y0))
+        angle = np.arctan2(c[:, 1] - y0, c[:, 0] - x0)
+
+        for t in tiers:
+            a = r0 + self.tiers[t]
+
+            # shrink the blocking radius so that rounding in the
+            # proposed positions can never make a blocked one valid
+            b = c[:, 2] + self.tiers[t] - 4 * EPSILON
+            blocking = d < a + b
+            cos = (_squared(a) + _squared(d[blocking]) -
+                   _squared(b[blocking])) / (2 * a * d[blocking])
+            if (cos <= -1).any():
+                return t
+
+            spread = np.arccos(cos[cos < 1])
+            start = (angle[blocking][cos < 1] - spread) % (2 * math.pi)
+            if not len(start):
+                continue
+
+            # the arcs cover the whole circle if, in order of where they
+            # start, each starts before the ones so far end
+            order = np.argsort(start)
+            start = start[order]
+            end = np.maximum.accumulate(start + spread[order] * 2)
+            if (start[1:] < end[:-1]).all() and end[-1] > start[0] + 2 * math.pi:
+                return t
+
+        return None
+
+
+def _neighbors(grid, alive, k, reach):
+    """Returns the indices of the living circles within reach of circle k
+    and their gaps to it
 
+    """
 
-def _propose(radius, proximities):
-    def _intersections(c1, c2):
-        x0, y0, r0 = c1
-        x1, y1, r1 = c2
+    x, y, r = grid.circles[k]
+    near = np.fromiter(grid.get_indices((x, y, r + reach + EPSILON)), np.int64)
+    near = near[(near != k) & alive[near]]
 
-        r0 += radius
-        r1 += radius
+    # the earlier circle's radius comes off first, as it always has
+    c = grid.circles.view()[near]
+    d = np.sqrt(_squared(c[:, 0] - x) + _squared(c[:, 1] - y))
+    gaps = np.maximum(0, np.where(near < k, d - c[:, 2] - r, d - r - c[:, 2]))
 
-        d = math.sqrt((x1 - x0)**2 + (y1 - y0)**2)
+    return near[gaps <= reach], gaps[gaps <= reach]
 
-        # no overlap
-        if d > r0 + r1:
-            return []
 
-        # a contains b
-        if d < abs(r0 - r1):
-            return []
+def _scan(grid, alive, indices, limit):
+    """Returns the pairs of living circles with at most limit between them
+    that start with one of the given ones, ordered by both indices
 
-        # a is b
-        if d == 0 and r0 == r1:
-            return []
+    """
+
+    return [(i, j) for i in indices
+            for j in sorted(k for k in _neighbors(grid, alive, i, limit)[0]
+                            if k > i)]
+
+
+class Front:
+    """Stores the chain of circles along the outside of the packing and
+    proposes positions that touch two adjacent circles on it
+
+    The chain runs so that the outside is always to the right. Pockets
+    that close up behind a new circle and are too narrow for the smallest
+    circle so far are cut out, so the chain only grows with the perimeter
+    of the packing rather than with the number of circles. A chain saved
+    from the next attribute can be passed back in along with its circles.
+
+    The circles on the chain are also kept in an array, in the order of
+    next, so that those near a target can be picked out without going
+    through all of them.
 
+    """
+
+    def __init__(self, circles=[], chain=None):
+        self.grid = Grid()
+        self.circles = self.grid.circles
+        self.next = {}
+        self.prev = {}
+        self.nodes = _Array(np.int64)
+        self.chained = _Array(bool)
+        self.proposed = (np.empty((0, 2)), np.empty(0, int))
+        self.minimum = math.inf
+        self.extent = 0
+
+        if chain is None:
+            for c in circles:
+                self.add_circle(c)
+        else:
+            for c in circles:
+                self._add(c)
+            for m, n in chain:
+                self._link(m, n)
+
+    def add_circle(self, circle):
+        k = self._add(circle)
+
+        if not self.next:
+            self._link(k, k)
+            return
+
+        # circles that were not proposed by the chain (i.e. the initial
+        # ones) are attached behind the closest circle on it
+        positions, edges = self.proposed
+        hits = np.flatnonzero((positions == circle[:2]).all(axis=1))
+        if len(hits):
+            m = int(edges[hits[0]])
         else:
-            a = (r0**2 - r1**2 + d**2) / (2 * d)
-            h = math.sqrt(r0**2 - a**2 + EPSILON)
-            x2 = x0 + a * (x1 - x0) / d
-            y2 = y0 + a * (y1 - y0) / d
-            x3 = x2 + h * (y1 - y0) / d
-            y3 = y2 - h * (x1 - x0) / d
+            m = min(
+                self.next,
+                key=lambda i: _distance(self.circles[i], circle) - self.
+                circles[i][2],
+            )
+        n = self.next[m]
+
+        self._link(m, k)
+        self._link(k, n)
+        self.proposed = (np.empty((0, 2)), np.empty(0, int))
+
+        for i in sorted(
+                self.grid.get_indices((
+                    circle[0],
+                    circle[1],
+                    circle[2] + self.minimum * 2,
+                ))):
+            if i == k or i not in self.next or i in (self.prev[k],
+                                                     self.next[k]):
+                continue
+            c = self.circles[i]
+            if _distance(c, circle) - c[2] - circle[2] < self.minimum * 2:
+                self._cut(k, i)
+
+    def _add(self, circle):
+        k = self.grid.add_circle(circle)
+        self.chained.extend([False])
+        self.minimum = min(self.minimum, circle[2])
+        self.extent = max(self.extent, _distance(circle) + circle[2])
+
+        return k
+
+    def _link(self, m, n):
+        if m not in self.next:
+            self.nodes.extend([m])
+            self.chained.data[m] = True
+        self.next[m] = n
+        self.prev[n] = m
+
+    def propose(self, radius, outward=False, target=(0, 0), within=math.inf):
+        """Returns the positions touching each pair of adjacent circles
+        from the outside, or touching each single circle straight away
+        from the origin if outward is set, as rows of an array, leaving out
+        the circles whose edge is further than within from the target
+
+        """
+
+        # the nodes of circles cut out of the chain are dropped here, so
+        # the rest stay in the order of next
+        nodes = self.nodes.view()
+        chained = self.chained.view()[nodes]
+        if not chained.all():
+            self.nodes.replace(nodes[chained])
+            nodes = self.nodes.view()
+
+        coords = self.circles.view()
+        if within < math.inf:
+            c = coords[nodes]
+            nodes = nodes[np.sqrt(
+                _squared(c[:, 0] - target[0]) +
+                _squared(c[:, 1] - target[1])) - c[:, 2] <= within]
+
+        first = nodes
+        second = np.fromiter(map(self.next.__getitem__, first.tolist()), int,
+                             len(first))
+
+        if outward:
+            x, y, r = coords[first].T
+            d = np.sqrt(_squared(x) + _squared(y))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                points = np.stack([
+                    np.where(d > 0, x + (r + radius) * x / d, x + r + radius),
+                    np.where(d > 0, y + (r + radius) * y / d, y),
+                ], axis=1)
+            valid = np.ones(len(first), bool)
+        else:
+            points, _, valid = _intersections_batch(
+                radius,
+                coords[first],
+                coords[second],
+            )
+            valid &= first != second
+
+        self.proposed = (points[valid], first[valid])
+        return points[valid]
+
+    def _cut(self, k, i):
+        # the pocket between k and i is whichever side of the chain is
+        # shorter, so walk both ways at once until i turns up
+        forward, backward = self.next[k], self.prev[k]
+        while forward != i and backward != i:
+            forward, backward = self.next[forward], self.prev[backward]
+
+        step = self.next if forward == i else self.prev
+        node = step[k]
+        while node != i:
+            following = step[node]
+            del self.next[node], self.prev[node]
+            self.chained.data[node] = False
+            node = following
+
+        if forward == i:
+            self._link(k, i)
+        else:
+            self._link(i, k)
+
+
+def _intersections(radius, c1, c2):
+    """Returns the centers of circles with the given radius that touch
+    both circles, starting with the one to the right of c1 towards c2
+
+    """
+
+    x0, y0, r0 = c1
+    x1, y1, r1 = c2
+
+    r0 += radius
+    r1 += radius
+
+    d = math.sqrt((x1 - x0)**2 + (y1 - y0)**2)
+
+    # no overlap
+    if d > r0 + r1:
+        return []
+
+    # a contains b
+    if d < abs(r0 - r1):
+        return []
+
+    # a is b
+    if d == 0 and r0 == r1:
+        return []
 
-            x4 = x2 - h * (y1 - y0) / d
-            y4 = y2 + h * (x1 - x0) / d
+    else:
+        a = (r0**2 - r1**2 + d**2) / (2 * d)
+        h = math.sqrt(r0**2 - a**2 + EPSILON)
+        x2 = x0 + a * (x1 - x0) / d
+        y2 = y0 + a * (y1 - y0) / d
+        x3 = x2 + h * (y1 - y0) / d
+        y3 = y2 - h * (x1 - x0) / d
 
-            if abs(_distance((x3, y3)) - _distance((x4, y4))) < EPSILON:
-                return [(x3, y3), (x4, y4)]
+        x4 = x2 - h * (y1 - y0) / d
+        y4 = y2 + h * (x1 - x0) / d
 
-            return [max(
-                [(x3, y3), (x4, y4)],
-                key=lambda p: _distance(p),
-            )]
+        return [(x3, y3), (x4, y4)]
+
+
+def _intersections_batch(radius, c1, c2):
+    """Vectorized version of _intersections over arrays of circle pairs,
+    returning both centers of every pair and whether they exist
+
+    """
+
+    x0, y0, r0 = c1.T
+    x1, y1, r1 = c2.T
+
+    r0 = r0 + radius
+    r1 = r1 + radius
+
+    d = np.sqrt(_squared(x1 - x0) + _squared(y1 - y0))
+
+    # no overlap, a contains b, a is b
+    valid = ~((d > r0 + r1) | (d < abs(r0 - r1)) | ((d == 0) & (r0 == r1)))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        a = (_squared(r0) - _squared(r1) + _squared(d)) / (2 * d)
+        h = np.sqrt(_squared(r0) - _squared(a) + EPSILON)
+        x2 = x0 + a * (x1 - x0) / d
+        y2 = y0 + a * (y1 - y0) / d
+        x3 = x2 + h * (y1 - y0) / d
+        y3 = y2 - h * (x1 - x0) / d
+
+        x4 = x2 - h * (y1 - y0) / d
+        y4 = y2 + h * (x1 - x0) / d
+
+    return np.stack([x3, y3], axis=1), np.stack([x4, y4], axis=1), valid
+
+
+def _propose(radius, proximities):
+    def _outermost(points):
+        if not points:
+            return []
+
+        if abs(_distance(points[0]) - _distance(points[1])) < EPSILON:
+            return points
+
+        return [max(
+            points,
+            key=lambda p: _distance(p),
+        )]
 
     return [
         p for c1, c2 in proximities.get_circles(radius * 2)
-        for p in _intersections(c1, c2)
+        for p in _outermost(_intersections(radius, c1, c2))
     ]
 
 
+def _propose_batch(radius, proximities, target=(0, 0), within=math.inf):
+    """Proposes the same positions as _propose in the same order, as rows
+    of an array, using a handful of array operations for all pairs at once
+
+    Each step repeats the scalar arithmetic in the same order and rounds
+    it the same way (see _squared), so positions agree with _propose to
+    the last bit; the tolerance is zero and the EPSILON comparisons are
+    made on identical values. Pairs with a circle further than within
+    from the target are left out (see Proximities.get_pairs).
+
+    """
+
+    first, second = proximities.get_pairs(radius * 2, target, within)
+    coords = proximities.circles.view()
+
+    p3, p4, valid = _intersections_batch(radius, coords[first], coords[second])
+    d3 = np.sqrt(_squared(p3[:, 0]) + _squared(p3[:, 1]))
+    d4 = np.sqrt(_squared(p4[:, 0]) + _squared(p4[:, 1]))
+
+    # keep both when they are (nearly) equally far out, otherwise only
+    # the outer one, with ties going to the first just like max does
+    tie = abs(d3 - d4) < EPSILON
+    keep = np.stack([
+        valid & (tie | (d3 >= d4)),
+        valid & (tie | (d4 > d3)),
+    ], axis=1)
+
+    return np.stack([p3, p4], axis=1)[keep]
+
+
+def _place(radius, proximities, target=(0, 0), pool=None):
+    """Returns what _select would pick out of all the positions that the
+    Proximities or Front proposes, along with the seconds spent proposing
+    and how many positions were proposed
+
+    Proposed positions touch the circles they are proposed from, so they
+    are no closer to the target than the edges of those are, give or take
+    the EPSILON that _intersections adds. Positions are therefore proposed
+    from the circles in a disc around the target first, which doubles
+    until the closest valid one lies within it, and so is the closest of
+    all. If the target is a circle, positions are outside of it too.
+
+    """
+
+    everything = proximities.extent + _distance(target)
+    bound = radius * 8 + (target[2] if len(target) > 2 else 0)
+    seconds = count = 0
+
+    while True:
+        # touching a circle puts a position at most sqrt(EPSILON) closer
+        # to the target than its edge
+        within = bound + radius + 2 * math.sqrt(EPSILON)
+        if within >= everything:
+            within = math.inf
+
+        started = time.perf_counter()
+        positions = proximities.propose(radius, target=target, within=within)
+        seconds += time.perf_counter() - started
+        count += len(positions)
+
+        position = _select(radius, proximities.grid, positions, target, pool)
+        if within == math.inf:
+            return position, seconds, count
+
+        if position is None:
+            bound *= 2
+        elif _distance(position, target) > bound:
+            bound = _distance(position, target)
+        else:
+            return position, seconds, count
+
+
 def _filter(radius, grid, positions):
     def _valid(c1, c2):
         x0, y0, r0 = c1
@@ -214,104 +820,1096 @@ def _choose_user(radius, positions, funder):
             )) + [radius])
 
 
-def calculate(data):
-    assert len(data) >= 2
+def _collisions(radius, grid, points, neighborhoods):
+    """Returns for each point whether a circle with the given radius there
+    would collide with any of the circles in its neighborhood
 
-    circles = [
-        (0, 0, _radius(data[0][1])),
-        (0, _radius(data[0][1]) + _radius(data[1][1]), _radius(data[1][1])),
-    ]
+    """
+
+    owners = np.repeat(np.arange(len(points)), [len(n) for n in neighborhoods])
+    collides = np.zeros(len(points), bool)
+
+    if len(owners):
+        c = grid.circles.view()[[k for n in neighborhoods for k in n]]
+        p = points[owners]
+
+        d = np.sqrt(_squared(c[:, 0] - p[:, 0]) +
+                    _squared(c[:, 1] - p[:, 1])) + EPSILON
+        collides[owners[d < radius + c[:, 2]]] = True
+
+    return collides
+
+
+def _first_valid(radius, grid, points):
+    """Returns the index of the first point where a circle with the given
+    radius would not collide with any other, or None if there is none
+
+    """
+
+    # most positions lie inside the packing and already collide with a
+    # circle in their own square, so only check the full neighborhood of
+    # the ones that survive that, nearest first
+    collides = _collisions(
+        radius,
+        grid,
+        points,
+        [grid.get_cell(p) for p in points.tolist()],
+    )
+    rest = np.flatnonzero(~collides)
+
+    first, count = 0, 1
+    while first < len(rest):
+        chunk = points[rest[first:first + count]]
+        valid = np.flatnonzero(~_collisions(
+            radius,
+            grid,
+            chunk,
+            [list(grid.get_indices((p[0], p[1], radius)))
+             for p in chunk.tolist()],
+        ))
+        if len(valid):
+            return int(rest[first + valid[0]])
+
+        first, count = first + count, count * 2
+
+    return None
+
+
+def _select(radius, grid, positions, target=(0, 0), pool=None):
+    """Returns the valid position closest to the target, which is what
+    _choose_funder or _choose_user would pick out of _filter's result
+
+    Positions are validated in growing batches in order of distance, so
+    the search stops at the first batch that holds a valid one instead
+    of checking every position. Large batches are split up among the
+    processes of the pool if there is one. Returns None if no position
+    is valid.
+
+    """
+
+    if not len(positions):
+        return None
 
-    proximities = Proximities(circles)
-    grid = Grid(circles)
+    points = np.asarray(positions, float)
+    keys = np.sqrt(
+        _squared(points[:, 0] - target[0]) +
+        _squared(points[:, 1] - target[1]))
 
-    last_funder = circles[0]
+    # a stable sort keeps ties in their original order, so the first
+    # valid position in it is the same one min would return
+    order = np.argsort(keys, kind='stable')
 
-    for d in tqdm(data[2:]):
-        positions = _propose(_radius(d[1]), proximities)
-        valid = _filter(_radius(d[1]), grid, positions)
-        if d[1] > 0:
-            circle = _choose_funder(_radius(d[1]), valid)
-            last_funder = circle
+    start, size = 0, 8
+    while start < len(order):
+        batch = points[order[start:start + size]]
+
+        if pool and len(batch) >= pool.threshold:
+            k = pool.first_valid(radius, grid.circles, batch)
         else:
-            circle = _choose_user(_radius(d[1]), valid, last_funder)
-        circles.append(circle)
-        proximities.add_circle(circle)
-        grid.add_circle(circle)
+            k = _first_valid(radius, grid, batch)
+        if k is not None:
+            return tuple(batch[k].tolist())
+
+        start, size = start + size, size * 2
+
+    return None
+
+
+class Pool:
+    """Runs the pair scans and large candidate checks of single insertions
+    on several worker processes
+
+    Workers read the circles and which of them are alive from shared
+    memory and keep a grid of their own, so tasks only carry what is
+    being checked. Work is split into consecutive parts whose results
+    are combined in order, so they are the same as with one process.
+
+    Most insertions only look at a few hundred positions, which takes
+    less time than handing them to the workers, so only the scans for
+    large circles and batches of at least threshold positions are shared.
+    These are about a third of exact packing, which caps the gain at
+    about 1.5 times however many workers there are, and each worker holds
+    a grid of all circles on top of that.
+
+    """
+
+    def __init__(self, workers, threshold=1024):
+        self.workers = workers
+        self.threshold = threshold
+        self.memory = None
+        self.capacity = 0
+        self.size = 0
+
+        # sharing memory before starting the workers lets them use the
+        # resource tracker of this process rather than each their own,
+        # which would remove the memory as soon as a worker exits
+        self._share(Circles())
+        self.pool = multiprocessing.Pool(workers)
+
+    def scan(self, circles, alive, limit):
+        shared = self._share(circles, alive)
+        parts = np.array_split(np.flatnonzero(alive), self.workers * 4)
+
+        return np.concatenate(self.pool.starmap(
+            _scan_shared,
+            [(shared, part, limit) for part in parts],
+        ))
+
+    def first_valid(self, radius, circles, points):
+        shared = self._share(circles)
+        parts = np.array_split(np.arange(len(points)), self.workers)
+
+        for part, k in zip(
+                parts,
+                self.pool.starmap(
+                    _first_valid_shared,
+                    [(shared, radius, points[part]) for part in parts],
+                )):
+            if k is not None:
+                return int(part[k])
+
+        return None
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        if self.memory:
+            self.memory.close()
+            self.memory.unlink()
+
+    def _share(self, circles, alive=None):
+        """Copies what changed since the last call to shared memory, which
+        holds the x, y and r columns followed by the alive flags, and
+        returns what the workers need to find it
+
+        """
+
+        if not self.memory or len(circles) > self.capacity:
+            self.capacity = max(len(circles) * 2, 1024)
+            memory = shared_memory.SharedMemory(
+                create=True, size=self.capacity * 25)
+
+            # workers still attached to the old block move over once
+            # they see the new name
+            if self.memory:
+                self.memory.close()
+                self.memory.unlink()
+            self.memory = memory
+            self.size = 0
+
+        columns, flags = _attach(self.memory, self.capacity)
+        columns[:, self.size:len(circles)] = circles.columns()[:, self.size:]
+        if alive is not None:
+            flags[:len(alive)] = alive
+        else:
+            flags[self.size:len(circles)] = True
+        self.size = len(circles)
+
+        return self.memory.name, self.capacity, self.size
+
+
+def _attach(memory, capacity):
+    columns = np.ndarray((3, capacity), float, memory.buf)
+    flags = np.ndarray(capacity, bool, memory.buf, offset=capacity * 24)
+    return columns, flags
+
+
+# state of a worker process of a Pool
+_worker = {'memory': None, 'grid': None}
+
+
+def _sync(shared):
+    """Indexes the circles that were added since the last task of this
+    worker and returns its grid along with the alive flags
+
+    """
+
+    name, capacity, size = shared
+
+    memory = _worker['memory']
+    if memory is None or memory.name != name:
+        if memory:
+            memory.close()
+        memory = _worker['memory'] = shared_memory.SharedMemory(name)
+
+    if _worker['grid'] is None:
+        _worker['grid'] = Grid()
+    grid = _worker['grid']
+
+    columns, flags = _attach(memory, capacity)
+    for c in columns[:, len(grid.circles):size].T.tolist():
+        grid.add_circle(tuple(c))
+
+    return grid, flags[:size]
+
+
+def _scan_shared(shared, indices, limit):
+    grid, alive = _sync(shared)
+
+    # arrays travel back much faster than lists of numpy integers
+    return np.array(_scan(grid, alive, indices, limit), np.int64).reshape(-1, 2)
+
+
+def _first_valid_shared(shared, radius, points):
+    grid, _ = _sync(shared)
+    return _first_valid(radius, grid, points)
+
+
+def calculate(data,
+              front=False,
+              state=None,
+              checkpoint=None,
+              every=10000,
+              interval=60,
+              stats=None,
+              workers=1,
+              radii=None):
+    """Packs one circle per [name, amount, ...] entry around the previous
+    ones, either considering every pair of circles in the packing or, if
+    front is set, only adjacent circles along its outer boundary
+
+    Packing is sequential, so the circles of a prefix of data do not
+    depend on what follows. If state holds the 'circles' (and for front
+    the 'chain') of an earlier run over a prefix of data, packing carries
+    on from there. Either way state is updated in place with the result
+    and the 'digest' of the data it was calculated from.
+
+    Data can be any iterable and is read only once, front to back, so
+    it can be a generator over inputs too large to keep in memory.
+
+    If given, checkpoint is called with the state after every so many
+    circles or interval seconds, whichever comes first. If stats is a
+    dict, it is filled with the seconds spent in each stage, counts of
+    proposed positions and stored pairs and samples of how they and the
+    peak memory grow, which are also shown on the progress bar.
+
+    With more than one worker, the pair scans and long candidate checks
+    of packing every pair are shared among that many processes (see
+    Pool), with the same result. Front packing has none of these.
+
+    Packing every pair depends on the smallest and the median radius of
+    all circles, which are taken from radii if given (see _radii) and
+    otherwise from a first pass over data, which is kept in memory for
+    that if it is an iterator.
+
+    """
+
+    if state is None:
+        state = {}
+
+    if not front and radii is None:
+        if iter(data) is data:
+            data = list(data)
+        radii = _radii(data)
+
+    total = len(data) if hasattr(data, '__len__') else None
+    data = iter(data)
+
+    circles = state.get('circles', [])
+    if len(circles) < 2:
+        prefix = list(itertools.islice(data, 2))
+        assert len(prefix) == 2
+        circles = [
+            (0, 0, _radius(prefix[0][1])),
+            (0, _radius(prefix[0][1]) + _radius(prefix[1][1]),
+             _radius(prefix[1][1])),
+        ]
+    else:
+        prefix = itertools.islice(data, len(circles))
+    if not isinstance(circles, Circles):
+        circles = Circles(circles)
+    state['circles'] = circles
+
+    digest = _digest(front)
+    funder = count = 0
+    for count, d in enumerate(prefix, 1):
+        digest.update(struct.pack('<d', d[1]))
+        if count > 2 and d[1] > 0:
+            funder = count - 1
+    assert count == len(circles), 'Fewer entries than circles'
+    state['digest'] = digest.hexdigest()
+
+    # timing every circle costs next to nothing, so only sampling memory
+    # and the progress bar depend on whether stats were asked for
+    seconds = dict.fromkeys(['propose', 'select', 'insert', 'checkpoint'], 0.0)
+    counts = dict.fromkeys(['circles', 'positions', 'fallbacks', 'pairs'], 0)
+    samples = []
+    if stats is not None:
+        stats.update(seconds=seconds, counts=counts, samples=samples)
+
+    following = next(data, None)
+    if following is None:
+        return circles
+    data = itertools.chain([following], data)
+
+    pool = Pool(workers) if workers > 1 and not front else None
+
+    if front:
+        proximities = Front(circles, state.get('chain'))
+    else:
+        # keep pairs around for the common small circles and scan for
+        # the rare large ones on demand
+        proximities = Proximities(
+            circles,
+            minimum=radii[0],
+            reach=radii[1] * 4,
+            pool=pool,
+        )
+    grid = proximities.grid
+    circles = state['circles'] = proximities.circles
+
+    last_funder = circles[funder]
+
+    saved = len(circles)
+    clock = time.monotonic()
+
+    try:
+        progress = tqdm(data, initial=len(circles), total=total)
+        for d in progress:
+            digest.update(struct.pack('<d', d[1]))
+            radius = _radius(d[1])
+            target = (0, 0) if d[1] > 0 else last_funder
+
+            started = time.perf_counter()
+            position, proposing, proposed = _place(radius, proximities, target,
+                                                   pool)
+            counts['positions'] += proposed
+
+            if front and position is None:
+                positions = proximities.propose(radius, outward=True)
+                position = _select(radius, grid, positions, target, pool)
+                counts['positions'] += len(positions)
+                counts['fallbacks'] += 1
+
+            assert position is not None, 'No room for circle {}'.format(d[0])
+
+            circle = position + (radius, )
+            if d[1] > 0:
+                last_funder = circle
+            selected = time.perf_counter()
+            proximities.add_circle(circle)
+            inserted = time.perf_counter()
+
+            seconds['propose'] += proposing
+            seconds['select'] += selected - started - proposing
+            seconds['insert'] += inserted - selected
+            counts['circles'] += 1
+
+            if checkpoint and (len(circles) - saved >= every
+                               or time.monotonic() - clock >= interval):
+                if front:
+                    state['chain'] = list(proximities.next.items())
+                state['digest'] = digest.hexdigest()
+                checkpoint(state)
+                saved = len(circles)
+                clock = time.monotonic()
+                seconds['checkpoint'] += time.perf_counter() - inserted
+
+            if stats is not None and len(circles) % 1000 == 0:
+                counts['pairs'] = len(proximities.next if front else
+                                      proximities)
+                samples.append({
+                    'circles': len(circles),
+                    'positions': counts['positions'],
+                    'pairs': counts['pairs'],
+                    'memory': _peak_memory(),
+                })
+                progress.set_postfix(samples[-1], refresh=False)
+    finally:
+        if pool:
+            pool.close()
+
+    if front:
+        state['chain'] = list(proximities.next.items())
+    state['digest'] = digest.hexdigest()
+
+    if stats is not None:
+        counts['pairs'] = len(proximities.next if front else proximities)
+        stats['memory'] = _peak_memory()
 
     return circles
 
 
+def _radii(data):
+    """Returns the smallest and the median radius of the circles for the
+    entries of data, keeping nothing but their radii in memory
+
+    """
+
+    radii = np.sort(np.fromiter((_radius(d[1]) for d in data), float))
+    return float(radii[0]), float(radii[len(radii) // 2])
+
+
+def _color(item, highlight):
+    if item[1] > 0:
+        return COLORS[0]
+    if item[0] and item[0] in highlight:
+        return COLORS[2]
+    return COLORS[1]
+
+
 def render(circles, data, size, highlight=[], output='circles.svg'):
-    d = draw.Drawing(size, size, origin='center')
-    d.append(draw.Rectangle(
-        -size / 2,
-        -size / 2,
-        size,
-        size,
-        fill='white',
-    ))
-
-    for i, item in enumerate(zip(circles, data)):
-        circle = item[0]
-
-        if item[1][1] > 0:
-            color = '#3b3b3b'
+    """Writes the circles to output as SVG, gzipped if it ends in .svgz,
+    one element at a time and exactly the way drawSvg would lay them out
+
+    """
+
+    highlight = set(highlight)
+    opener = gzip.open if output.endswith('.svgz') else open
+
+    with opener(output, 'wt', encoding='utf-8') as fd:
+        fd.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<svg xmlns="http://www.w3.org/2000/svg"'
+            ' xmlns:xlink="http://www.w3.org/1999/xlink"\n'
+            '     width="{0}" height="{0}" viewBox="{1} {1} {0} {0}">\n'
+            '<defs>\n</defs>\n'
+            '<rect x="{1}" y="{1}" width="{0}" height="{0}" fill="white" />\n'
+            .format(size, -size / 2))
+
+        for circle, item in zip(circles, data):
+            color = _color(item, highlight)
+
+            # svg's y axis points down
+            fd.write(
+                '<circle cx="{}" cy="{}" r="{}" fill="{}" amount="{}"'
+                ' person="{}" target="{}" description="{}" />\n'.format(
+                    circle[0],
+                    -circle[1],
+                    circle[2],
+                    color,
+                    item[1],
+                    html.escape(item[0]),
+                    html.escape(item[2]) if len(item) >= 4 else '',
+                    html.escape(item[3]) if len(item) >= 4 else '',
+                ))
+
+        fd.write('</svg>')
+
+
+def raster(circles,
+           data,
+           size,
+           highlight=[],
+           output='circles.png',
+           pixels=1024,
+           supersample=1,
+           batch=2**22):
+    """Draws the circles straight into an image of pixels by pixels and
+    writes it to output as PNG
+
+    Each pixel takes the color of the circle that its center falls into,
+    and with supersample the image is drawn that many times larger and
+    then averaged down, which smooths the edges. Circles are drawn in
+    batches of similar size, so that all of a batch is a few array
+    operations on boxes of the same shape with about batch pixels in all.
+
+    """
+
+    highlight = set(highlight)
+    palette = np.array([[int(c[i:i + 2], 16) for i in (1, 3, 5)]
+                        for c in COLORS], np.uint8)
+    codes = np.fromiter(
+        (COLORS.index(_color(item, highlight)) for item in data),
+        np.uint8,
+    )
+
+    width = pixels * supersample
+    scale = width / size
+    image = np.full((width, width, 3), 255, np.uint8)
+
+    # pixel coordinates, with the y axis pointing down like svg's
+    coords = circles.view()
+    x = (coords[:, 0] + size / 2) * scale
+    y = (size / 2 - coords[:, 1]) * scale
+    r = coords[:, 2] * scale
+
+    # circles don't overlap, so the order they are drawn in doesn't matter
+    order = np.argsort(r, kind='stable')
+    radii = r[order]
+    start = 0
+    while start < len(order):
+        # the circles up to twice as large as the smallest left, as long as
+        # their boxes have about batch pixels in all
+        limit = np.searchsorted(radii, 2 * radii[start] + 1, 'right')
+        box = int(np.ceil(2 * radii[limit - 1])) + 2
+        end = min(limit, start + max(1, batch // box**2))
+        k = order[start:end]
+
+        left = np.floor(x[k] - r[k]).astype(np.int64)
+        top = np.floor(y[k] - r[k]).astype(np.int64)
+        steps = np.arange(box)
+
+        # and very large circles a few rows of their box at a time
+        rows = max(1, batch // (box * len(k)))
+        for offset in range(0, box, rows):
+            px = left[:, None, None] + steps[None, None, :]
+            py = top[:, None, None] + steps[None, offset:offset + rows, None]
+            inside = (((px + 0.5 - x[k, None, None])**2 +
+                       (py + 0.5 - y[k, None, None])**2 <= r[k, None, None]**2)
+                      & (px >= 0) & (px < width) & (py >= 0) & (py < width))
+            owner = np.broadcast_to(k[:, None, None], inside.shape)[inside]
+            image[np.broadcast_to(py, inside.shape)[inside],
+                  np.broadcast_to(px, inside.shape)[inside]] = palette[
+                      codes[owner]]
+
+        start = end
+
+    if supersample > 1:
+        area = supersample**2
+        image = ((image.reshape(pixels, supersample, pixels, supersample,
+                                3).sum(axis=(1, 3), dtype=np.uint32) +
+                  area // 2) // area).astype(np.uint8)
+
+    _write_png(output, image)
+
+
+def _write_png(path, image):
+    """Writes an (height, width, 3) array of bytes as an RGB PNG"""
+
+    def chunk(kind, body):
+        return (struct.pack('>I', len(body)) + kind + body +
+                struct.pack('>I', zlib.crc32(kind + body)))
+
+    height, width = image.shape[:2]
+
+    # every row starts with the byte of its filter, here none
+    rows = np.zeros((height, 1 + 3 * width), np.uint8)
+    rows[:, 1:] = image.reshape(height, -1)
+
+    with open(path, 'wb') as fd:
+        fd.write(b'\x89PNG\r\n\x1a\n')
+        fd.write(
+            chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0,
+                                       0)))
+        fd.write(chunk(b'IDAT', zlib.compress(rows.tobytes(), 6)))
+        fd.write(chunk(b'IEND', b''))
+
+
+def tile(circles,
+         data,
+         size,
+         directory,
+         highlight=[],
+         levels=None,
+         pixels=256,
+         chunk=1024):
+    """Writes a pyramid of SVG tiles of the circles to directory along with
+    an index of the circles in each tile and their metadata in chunks
+
+    Level z is split into 2**z by 2**z tiles of the given number of pixels
+    and each tile is written to z/x/y.svg and z/x/y.json, which lists the
+    [id, cx, cy, r] of its circles. Circles less than a pixel across at a
+    level are merged into one circle of their combined area for every few
+    pixels, so tiles stay small no matter how many circles there are. The
+    [amount, person, target, description] of circle id are at position
+    id % chunk of meta/<id // chunk>.json. Unless given, there are enough
+    levels to show the smallest circle on the last one.
+
+    """
+
+    highlight = set(highlight)
+    coords = circles.view()
+
+    # svg's y axis points down
+    x, y, r = coords[:, 0], -coords[:, 1], coords[:, 2]
+
+    os.makedirs(os.path.join(directory, 'meta'), exist_ok=True)
+    colors = _Array(np.uint8)
+    data = iter(data)
+    for k in itertools.count():
+        items = list(itertools.islice(data, chunk))
+        if not items:
+            break
+
+        with open(os.path.join(directory, 'meta', '{}.json'.format(k)),
+                  'w') as fd:
+            json.dump([[
+                item[1],
+                item[0],
+                item[2] if len(item) >= 4 else '',
+                item[3] if len(item) >= 4 else '',
+            ] for item in items], fd)
+        colors.extend([COLORS.index(_color(i, highlight)) for i in items])
+    colors = colors.view()
+
+    if levels is None:
+        levels = min(
+            1 + max(0, math.ceil(math.log2(size / (2 * pixels * r.min())))),
+            12,
+        )
+
+    for z in range(levels):
+        count = 2**z
+        span = size / count
+        scale = pixels / span
+
+        # tenths of a pixel are precise enough at this level
+        digits = max(0, math.ceil(math.log10(scale * 10)))
+
+        shown = np.flatnonzero(r * scale >= 0.5)
+        merged = np.flatnonzero(r * scale < 0.5)
+
+        # every tile that each shown circle reaches into
+        def _tiles(lower, upper):
+            return np.clip(
+                np.floor((np.stack([lower, upper]) + size / 2) / span),
+                0,
+                count - 1,
+            ).astype(np.int64)
+
+        xs = _tiles(x[shown] - r[shown], x[shown] + r[shown])
+        ys = _tiles(y[shown] - r[shown], y[shown] + r[shown])
+        width = xs[1] - xs[0] + 1
+        reach = width * (ys[1] - ys[0] + 1)
+        offset = np.arange(reach.sum()) - np.repeat(
+            np.cumsum(reach) - reach, reach)
+        owners = np.repeat(shown, reach)
+        keys = ((np.repeat(ys[0], reach) + offset // np.repeat(width, reach))
+                * count + np.repeat(xs[0], reach) +
+                offset % np.repeat(width, reach))
+
+        # the order within a tile stays that of the circles, which is the
+        # order they are drawn in
+        order = np.argsort(keys, kind='stable')
+        keys, owners = keys[order], owners[order]
+
+        # merge the small circles of each square of four pixels into one
+        # at their center of area, colored like most of that area
+        cells = pixels // 4
+        gx = np.clip(np.floor((x[merged] + size / 2) / span * cells), 0,
+                     count * cells - 1).astype(np.int64)
+        gy = np.clip(np.floor((y[merged] + size / 2) / span * cells), 0,
+                     count * cells - 1).astype(np.int64)
+        squares, inverse = np.unique(
+            gy * count * cells + gx, return_inverse=True)
+        area = np.bincount(inverse, r[merged]**2, len(squares))
+        blobs = np.stack([
+            np.bincount(inverse, r[merged]**2 * x[merged], len(squares)) /
+            area,
+            np.bincount(inverse, r[merged]**2 * y[merged], len(squares)) /
+            area,
+            np.sqrt(area),
+            np.bincount(inverse, r[merged]**2 *
+                        (colors[merged] == 0), len(squares)) * 2 > area,
+        ], axis=1)
+        blob_keys = (squares // (count * cells) // cells * count +
+                     squares % (count * cells) // cells)
+
+        for key in np.union1d(keys, blob_keys).tolist():
+            ty, tx = divmod(key, count)
+            path = os.path.join(directory, str(z), str(tx))
+            os.makedirs(path, exist_ok=True)
+
+            inside = owners[np.searchsorted(keys, key):np.searchsorted(
+                keys, key, 'right')]
+            rows = (np.round(
+                np.stack([x[inside], y[inside], r[inside]], axis=1), digits) +
+                    0.0).tolist()
+
+            with open(os.path.join(path, '{}.svg'.format(ty)), 'w') as fd:
+                fd.write(
+                    '<svg xmlns="http://www.w3.org/2000/svg" width="{0}"'
+                    ' height="{0}" viewBox="{1} {2} {3} {3}">\n'
+                    '<rect x="{1}" y="{2}" width="{3}" height="{3}"'
+                    ' fill="white" />\n'.format(
+                        pixels,
+                        tx * span - size / 2,
+                        ty * span - size / 2,
+                        span,
+                    ))
+                for bx, by, br, funded in np.round(
+                        blobs[blob_keys == key], digits).tolist():
+                    fd.write('<circle cx="{}" cy="{}" r="{}" fill="{}" />\n'
+                             .format(bx, by, br, COLORS[0 if funded else 1]))
+                for k, row in zip(inside.tolist(), rows):
+                    fd.write('<circle cx="{}" cy="{}" r="{}" fill="{}" />\n'
+                             .format(*row, COLORS[colors[k]]))
+                fd.write('</svg>')
+
+            with open(os.path.join(path, '{}.json'.format(ty)), 'w') as fd:
+                json.dump(
+                    [[k] + row for k, row in zip(inside.tolist(), rows)],
+                    fd,
+                    separators=(',', ':'),
+                )
+
+    with open(os.path.join(directory, 'pyramid.json'), 'w') as fd:
+        json.dump({
+            'size': size,
+            'levels': levels,
+            'pixels': pixels,
+            'chunk': chunk,
+            'circles': len(circles),
+        }, fd, indent=2)
+
+
+def animate(data, output='circles.timeline.json'):
+    """Writes everything the story page animates for each entry of data in
+    one pass, so that the page doesn't have to work it out from the SVG
+
+    The manifest at output has the totals that the story quotes, and the
+    type, offset and length of every array in the little-endian binary file
+    next to it: the amount and running total of each circle, the funder it
+    spends from and the ratio that funder shrinks to, and the HTML of the
+    feed line and description of each circle as UTF-8 with the offsets that
+    they start at.
+
+    """
+
+    # appending to the standard library's arrays is much cheaper than
+    # growing numpy ones one entry at a time
+    arrays = {
+        'amount': array.array('d'),
+        'total': array.array('d'),
+        'funder': array.array('i'),
+        'ratio': array.array('f'),
+        'feed': array.array('B'),
+        'feed_offset': array.array('I', [0]),
+        'description': array.array('B'),
+        'description_offset': array.array('I', [0]),
+    }
+
+    funder = None
+    initial = None
+    total = given = donations = count = 0
+    donors = set()
+
+    for count, item in enumerate(data, 1):
+        k = count - 1
+        amount = item[1]
+        total += amount
+
+        # a funder shrinks as the users after it spend what it gave, and
+        # only hands over to the next one once that has been added
+        if funder is None:
+            funder = (k, amount)
+        arrays['amount'].append(amount)
+        arrays['total'].append(total)
+        arrays['funder'].append(funder[0])
+        arrays['ratio'].append(math.sqrt(max(0, 1 - total / funder[1])))
+
+        if amount > 0:
+            funder = (k, amount)
+            if k and initial is None:
+                initial = k - 1
+            feed = '&larr; {}'.format(html.escape(item[0]))
         else:
-            if item[1][0] and item[1][0] in highlight:
-                color = '#ffff00'
-            else:
-                color = '#84ab3f'
+            given -= amount
+            donations += 1
+            donors.add(item[0])
+            feed = '{} &rarr; {}'.format(
+                html.escape(item[0]),
+                html.escape(item[2]) if len(item) >= 4 else '',
+            )
 
-        d.append(
-            draw.Circle(
-                *circle,
-                fill=color,
-                amount=item[1][1],
-                person=html.escape(item[1][0]),
-                target=html.escape(item[1][2]) if len(item[1]) >= 4 else '',
-                description=html.escape(item[1][3])
-                if len(item[1]) >= 4 else '',
-            ))
+        for name, text in [
+            ('feed', feed),
+            ('description', html.escape(item[3]) if len(item) >= 4 else ''),
+        ]:
+            arrays[name].frombytes(text.encode())
+            arrays[name + '_offset'].append(len(arrays[name]))
+
+    # the first funder is followed by the users that spent only from it
+    if initial is None:
+        initial = max(count - 1, 0)
+
+    root, ext = os.path.splitext(output)
+    binary = root + '.bin'
+    manifest = {
+        'binary': os.path.basename(binary),
+        'circles': count,
+        'initial': initial,
+        'donors': len(donors),
+        'donations': donations,
+        'given': given,
+        'arrays': {},
+    }
+
+    types = {
+        'd': 'Float64Array',
+        'f': 'Float32Array',
+        'i': 'Int32Array',
+        'I': 'Uint32Array',
+        'B': 'Uint8Array',
+    }
+
+    with open(binary, 'wb') as fd:
+        for name, values in arrays.items():
+            if sys.byteorder == 'big':
+                values.byteswap()
+
+            # typed arrays have to start at a multiple of their item size
+            fd.write(bytes(-fd.tell() % 8))
+            manifest['arrays'][name] = {
+                'type': types[values.typecode],
+                'offset': fd.tell(),
+                'length': len(values),
+            }
+            values.tofile(fd)
+
+    with open(output, 'w') as fd:
+        json.dump(manifest, fd, indent=2)
+
+
+def _digest(front):
+    """Returns the hash that layouts are keyed by, to be updated with the
+    amount of every entry packed, since the amounts and the packing mode
+    are all that a layout depends on
 
-    d.saveSvg(output)
+    """
 
+    return hashlib.sha256(b'front' if front else b'all')
 
-def run(funders, users, highlight=[], output='circles.svg'):
 
-    data = []
+def _read_layout(path):
+    """Reads a layout written by _write_layout, leaving the circles of the
+    binary format on disk until they are used
+
+    """
+
+    if path.endswith('.json'):
+        with open(path) as fd:
+            state = json.load(fd)
+        if not isinstance(state, dict):
+            raise ValueError('{} is not a layout'.format(path))
+
+        state['circles'] = Circles(state.get('circles', []))
+        return state
+
+    with open(path, 'rb') as fd:
+        if fd.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a layout'.format(path))
+        length, = struct.unpack('<Q', fd.read(8))
+        state = json.loads(fd.read(length))
+
+    count = state.pop('count')
+    state['circles'] = Circles(columns=np.memmap(
+        path,
+        '<f8',
+        'r',
+        offset=len(MAGIC) + 8 + length,
+        shape=(3, count),
+    ) if count else np.empty((3, 0)))
+    return state
+
+
+def _write_layout(path, state, indent=2):
+    """Writes the layout as JSON if path ends in .json and otherwise as
+    the magic, the length of a JSON header with everything but the
+    circles, the header and the x, y and r columns as float64
+
+    """
+
+    if path.endswith('.json'):
+        with open(path, 'w') as fd:
+            json.dump(
+                dict(state, circles=state['circles'].view().tolist()),
+                fd,
+                indent=indent,
+            )
+        return
+
+    header = dict(state, count=len(state['circles']))
+    del header['circles']
+    header = json.dumps(header).encode()
+
+    # pad the header so that the columns are aligned for the memory map
+    header += b' ' * (-(len(MAGIC) + 8 + len(header)) % 8)
+
+    with open(path, 'wb') as fd:
+        fd.write(MAGIC)
+        fd.write(struct.pack('<Q', len(header)))
+        fd.write(header)
+        for column in state['circles'].columns():
+            column.astype('<f8').tofile(fd)
+
+
+def _load_layout(path, data, front):
+    """Returns the packing state saved at path if it was calculated from
+    a prefix of data, which is only read as far as that prefix, or an
+    empty one otherwise
+
+    """
+
+    try:
+        state = _read_layout(path)
+    except (OSError, ValueError, KeyError, struct.error):
+        return {}
+
+    # layouts from before the cache was keyed cannot be trusted
+    digest = _digest(front)
+    for d in itertools.islice(data, len(state['circles'])):
+        digest.update(struct.pack('<d', d[1]))
+    if state.get('digest') != digest.hexdigest():
+        return {}
+
+    return state
+
+
+def _save_layout(path, state, indent=2):
+    """Writes state to path through a temporary file so that an
+    interrupted write never leaves a truncated layout behind
+
+    """
+
+    # keep the extension, which decides the format
+    root, ext = os.path.splitext(path)
+    _write_layout(root + '.tmp' + ext, state, indent)
+    os.replace(root + '.tmp' + ext, path)
+
+
+class Records:
+    """Reads the records of a JSON array, or of a JSON Lines file if the
+    path ends in .jsonl, one at a time and from the start every time it
+    is iterated
+
+    """
+
+    def __init__(self, path, chunk=2**16):
+        self.path = path
+        self.chunk = chunk
+
+    def __iter__(self):
+        lines = self.path.endswith('.jsonl')
+        decoder = json.JSONDecoder()
+        blank = re.compile(r'\s*')
+        separators = blank if lines else re.compile(r'[\s,]*')
+
+        with open(self.path) as fd:
+            buffer = ''
+            position = 0
+            opened = lines
+
+            while True:
+                position = (separators if opened else blank).match(
+                    buffer, position).end()
+
+                if position == len(buffer):
+                    buffer, position = fd.read(self.chunk), 0
+                    if buffer:
+                        continue
+                    if lines:
+                        return
+                    raise ValueError('{} ends within the array'.format(
+                        self.path))
+
+                if not opened:
+                    if buffer[position] != '[':
+                        raise ValueError('{} is not a JSON array'.format(
+                            self.path))
+                    opened = True
+                    position += 1
+                    continue
+
+                if not lines and buffer[position] == ']':
+                    return
+
+                try:
+                    record, end = decoder.raw_decode(buffer, position)
+                except ValueError:
+                    end = None
+
+                # a record that fails or reaches the end of the buffer
+                # may go on in the next chunk
+                if end is None or end == len(buffer):
+                    text = fd.read(self.chunk)
+                    if text:
+                        buffer, position = buffer[position:] + text, 0
+                        continue
+                    if end is None:
+                        raise ValueError('{} ends within a record'.format(
+                            self.path))
+
+                yield record
+                position = end
+
+
+def arrange(funders, users):
+    """Yields the [name, amount, ...] entries to pack, with funders as
+    positive amounts, each followed by the users it pays for as negative
+    ones, reading both only as far as needed
+
+    """
+
+    users = iter(users)
+    user = next(users, None)
     balance = 0
-    index = 0
 
     for name, amount in funders:
-        data.append((name, amount))
+        if amount >= 1 or amount <= -1:
+            yield (name, amount)
         balance += amount
 
-        while index < len(users) and users[index][1] <= balance:
-            balance -= users[index][1]
-            data.append((
-                users[index][0],
-                -users[index][1],
-                users[index][2],
-                users[index][3],
-            ))
-            index += 1
-
-        if index == len(users):
+        while user is not None and user[1] <= balance:
+            balance -= user[1]
+            if user[1] >= 1 or user[1] <= -1:
+                yield (user[0], -user[1], user[2], user[3])
+            user = next(users, None)
+
+        if user is None:
             break
 
-    data = [x for x in data if x[1] >= 1 or x[1] <= -1]
 
-    try:
-        with open('circles.json') as fd:
-            circles = json.load(fd)
-    except Exception:
-        circles = calculate(data)
-        with open('circles.json', 'w') as fd:
-            json.dump(circles, fd, indent=2)
+def run(funders,
+        users,
+        highlight=[],
+        output='circles.svg',
+        front=False,
+        resume=False,
+        layout='circles.bin',
+        stats=None,
+        workers=1,
+        tiles=None,
+        timeline=None,
+        pixels=1024,
+        supersample=1):
+
+    root, ext = os.path.splitext(layout)
+    checkpoint = root + '.checkpoint' + ext
+
+    # every pass reads the inputs afresh rather than keeping all of them
+    state = _load_layout(layout, arrange(funders, users), front)
+    if resume:
+        partial = _load_layout(checkpoint, arrange(funders, users), front)
+        if len(partial.get('circles', [])) > len(state.get('circles', [])):
+            state = partial
+    count = len(state.get('circles', []))
+
+    # JSON checkpoints skip the indentation to keep the C encoder fast
+    report = {} if stats else None
+    circles = calculate(
+        arrange(funders, users),
+        front,
+        state,
+        checkpoint=lambda state: _save_layout(checkpoint, state, indent=None),
+        stats=report,
+        workers=workers,
+        radii=None if front else _radii(arrange(funders, users)),
+    )
+    if stats:
+        with open(stats, 'w') as fd:
+            json.dump(report, fd, indent=2)
+    if len(circles) != count:
+        _save_layout(layout, state)
+
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
 
     size = 2 * max(_distance(c) + c[2] for c in circles)
-    render(circles, data, size, highlight, output)
+    if output.endswith('.png'):
+        raster(circles, arrange(funders, users), size, highlight, output,
+               pixels, supersample)
+    else:
+        render(circles, arrange(funders, users), size, highlight, output)
+    if tiles:
+        tile(circles, arrange(funders, users), size, tiles, highlight)
+
+    # the story page loads the timeline from next to the svg
+    if timeline is None and not output.endswith('.png'):
+        timeline = os.path.splitext(output)[0] + '.timeline.json'
+    if timeline:
+        animate(arrange(funders, users), timeline)
 
 
 if __name__ == '__main__':
@@ -323,12 +1921,12 @@ if __name__ == '__main__':
 
     parser.add_argument(
         'funders',
-        help='Path to JSON list of n pairs of [donor_name, total_donations]',
+        help='Path to JSON list (or .jsonl lines) of n pairs of [donor_name, total_donations]',
     )
 
     parser.add_argument(
         'users',
-        help='Path to JSON list of n pairs of [user_name, total_donations]',
+        help='Path to JSON list (or .jsonl lines) of n pairs of [user_name, total_donations]',
     )
 
     parser.add_argument(
@@ -342,17 +1940,82 @@ if __name__ == '__main__':
     parser.add_argument(
         '-o',
         '--output',
-        help='output file',
-        action='append',
+        help='output file, gzipped if it ends in .svgz or drawn as an image'
+        ' if it ends in .png',
         default='circles.svg',
     )
 
-    args = parser.parse_args()
+    parser.add_argument(
+        '-f',
+        '--front',
+        help='only pack along the outer boundary, which is much faster',
+        action='store_true',
+    )
+
+    parser.add_argument(
+        '-r',
+        '--resume',
+        help='continue from the checkpoint of an interrupted run',
+        action='store_true',
+    )
 
-    with open(args.funders) as fd:
-        funders = json.load(fd)
+    parser.add_argument(
+        '-c',
+        '--cache',
+        help='layout cache file, binary unless it ends in .json',
+        default='circles.bin',
+    )
+
+    parser.add_argument(
+        '-s',
+        '--stats',
+        help='write timings, counts and memory use of the packing as JSON',
+    )
+
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        help='number of processes to share the pair scans of packing every'
+        ' pair among',
+        type=int,
+        default=1,
+    )
+
+    parser.add_argument(
+        '-t',
+        '--tiles',
+        help='also write a pyramid of tiles for zooming to this directory',
+    )
+
+    parser.add_argument(
+        '-a',
+        '--timeline',
+        help='write the timeline of the story page to this JSON file rather'
+        ' than next to the svg output',
+    )
+
+    parser.add_argument(
+        '-p',
+        '--pixels',
+        help='width and height of .png output',
+        type=int,
+        default=1024,
+    )
+
+    parser.add_argument(
+        '--supersample',
+        help='draw .png output this many times larger and scale it down to'
+        ' smooth the edges',
+        type=int,
+        default=1,
+    )
+
+    args = parser.parse_args()
 
-    with open(args.users) as fd:
-        users = json.load(fd)
+    # streamed, so that only the packing has to fit into memory
+    funders = Records(args.funders)
+    users = Records(args.users)
 
-    run(funders, users, args.highlight, args.output)
+    run(funders, users, args.highlight, args.output, args.front,
+        args.resume, args.cache, args.stats, args.jobs, args.tiles,
+        args.timeline, args.pixels, args.supersample)
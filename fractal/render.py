@@ -1,8 +1,15 @@
 #!/usr/bin/python3
 
+import os
+import html
 import json
 import math
+import zlib
+import struct
 import argparse
+import itertools
+import multiprocessing
+import numpy as np
 import drawSvg as draw
 
 TIERS = [
@@ -58,6 +65,11 @@ EXTENSIONS = {
 
 
 def create_labels(data):
+    """Returns the [name, count] runs of the triangles each name gets on
+    every level, which are the digits of its value in base 4
+
+    """
+
     labels = []
 
     for name, value in data:
@@ -69,63 +81,224 @@ def create_labels(data):
             while len(labels) <= level:
                 labels.append([])
 
-            while value >= 4**level:
-                labels[level].append(name)
-                value -= 4**level
+            count = value // 4**level
+            labels[level].append([name, count])
+            value -= count * 4**level
 
     return labels
 
 
-def create_fractals(labels, max_level):
-    def create_fractal(h, x, y):
-        triangles = [[[
-            x - h,  # 0 (x0)
-            y + h,  # 1 (y1)
-            x,  # 2 (x1)
-            y + h * 2,  # 3 (y1)
-            x + h,  # 4 (x2)
-            y + h,  # 5 (y2)
-        ]]]
+def create_triangles(height):
+    """Yields the triangles of a Sierpinski gasket of the given height, one
+    level at a time from the largest, as rows of [x0, y0, x1, y1, x2, y2]
+
+    A gasket is its triangle over the gaskets of half its height at its
+    bottom, left and right, with the triangles of each level ordered as
+    those of the bottom one followed by those of the left and right ones
+    interleaved. So each level is the one before it halved and placed
+    three times, which only takes a few array operations.
+
+    """
+
+    # centers of a gasket of height 1 at the current level
+    centers = np.zeros((1, 2))
+    h = height
+
+    while True:
+        x, y = centers[:, 0] * height, centers[:, 1] * height
+        yield np.stack([x - h, y + h, x, y + h * 2, x + h, y + h], axis=1)
 
         if h <= 1:
-            return triangles
-
-        bottom = create_fractal(h / 2, x, y)
-        left = create_fractal(h / 2, x - h, y + h)
-        right = create_fractal(h / 2, x + h, y + h)
-
-        for i in range(len(bottom) - 1, -1, -1):
-            triangles = [
-                bottom[i] + [y for x in zip(left[i], right[i]) for y in x]
-            ] + triangles
-
-        return triangles
-
-    # calculate the size of sierpinski gaskets that we need
-    if not max_level:
-        max_height = 0
-        for level, names in enumerate(labels):
-            if len(names):
-                height = int(2**math.ceil(
-                    math.log(math.ceil(len(names) / 4), 3)) * 2**level)
-                max_height = height if height > max_height else max_height
-    else:
-        max_height = 2**(max_level - 1)
+            return
+
+        half = centers / 2
+        sides = np.empty((2 * len(half), 2))
+        sides[0::2] = half + (-1, 1)
+        sides[1::2] = half + (1, 1)
+        centers = np.concatenate([half, sides])
+        h /= 2
+
+
+def load_triangles(height, cache=None):
+    """Returns the triangles of each level of a gasket of the given height
+    from the smallest, memory mapped from the cache directory if set
+
+    The geometry only depends on the height, so it is built once per height
+    and stored as one .npy array of all levels, which are 3**k long.
+
+    """
+
+    if not cache:
+        return list(create_triangles(height))[::-1]
+
+    path = os.path.join(cache, 'triangles-{}.npy'.format(height))
+    if not os.path.exists(path):
+        os.makedirs(cache, exist_ok=True)
+        temporary = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temporary, 'wb') as fd:
+            np.save(fd, np.concatenate(list(create_triangles(height))[::-1]))
+        os.replace(temporary, path)
+
+    array = np.load(path, mmap_mode='r')
+
+    # the largest level has one triangle and each one below three times
+    # as many as the one above it
+    sizes = []
+    while sum(sizes) < len(array):
+        sizes.insert(0, 3**len(sizes))
+    ends = np.cumsum(sizes)
+    return [array[end - size:end] for size, end in zip(sizes, ends)]
+
+
+def fractal_height(labels, max_level):
+    """Returns the height of the gaskets that fit the labels, or that have
+    max_level levels if it is set
+
+    """
+
+    if max_level:
+        return 2**(max_level - 1)
+
+    max_height = 0
+    for level, runs in enumerate(labels):
+        slots = sum(count for _, count in runs)
+        if slots:
+            height = int(2**math.ceil(math.log(math.ceil(slots / 4), 3)) *
+                         2**level)
+            max_height = height if height > max_height else max_height
+    return max_height
+
+
+def create_fractals(labels, max_level, cache=None):
+    """Returns the triangles of each level, shared by all four quadrants,
+    and the label of each triangle of each level in each quadrant
+
+    """
+
+    triangles = load_triangles(fractal_height(labels, max_level), cache)
+
+    # names go round the quadrants, one triangle of each at a time, and
+    # the slots only ever refer to the names rather than copy them
+    labeled = [[np.full(len(t), '', object) for t in triangles]
+               for _ in range(4)]
+    for level, runs in enumerate(labels[:len(triangles)]):
+        if not runs:
+            continue
+        names = np.empty(len(runs), object)
+        names[:] = [name for name, _ in runs]
+        counts = np.minimum(
+            np.cumsum([count for _, count in runs]),
+            4 * len(triangles[level]),
+        )
+        names = np.repeat(names, np.diff(counts, prepend=0))
+        for quadrant in range(4):
+            quarter = names[quadrant::4]
+            labeled[quadrant][level][:len(quarter)] = quarter
+
+    return triangles, labeled
+
+
+def _ancestors(index, depth, above):
+    """Returns the index at depth above of the triangle that each triangle
+    of index at depth is in, depth being the number of halvings from the
+    largest triangle as ordered by create_triangles
+
+    """
+
+    # which of the bottom, left and right gaskets the way down turns to
+    turns = []
+    for d in range(depth, depth - above, -1):
+        n = 3**(d - 1)
+        bottom = index < n
+        turns.append(np.where(bottom, 0, 1 + (index - n) % 2))
+        index = np.where(bottom, index, (index - n) // 2)
+
+    ancestor = np.zeros_like(index)
+    for d, turn in enumerate(turns[::-1], 1):
+        ancestor = np.where(turn == 0, ancestor,
+                            3**(d - 1) + 2 * ancestor + turn - 1)
+    return ancestor
+
+
+def cull_figure(triangles, labels, pixels, detail, skin):
+    """Returns the triangles and labels without the levels whose triangles
+    are less than detail pixels high, and the regions that they covered
+    with the average color of each
+
+    The gasket below every triangle of the largest level left out is an
+    upside down triangle twice its size, which is what the regions are,
+    in the same [x0, y0, x1, y1, x2, y2] rows as the triangles and with
+    an (n, 3) array of colors for each quadrant.
+
+    """
 
-    fractals = [create_fractal(max_height, 0, 0) for _ in range(4)]
+    ml = len(triangles)
+    cut = sum(1 for l in range(ml) if 2**l * pixels < detail)
+    if not cut:
+        return triangles, labels, None
+
+    # the regions of the gaskets below the largest triangles left out
+    top = triangles[cut - 1]
+    h = top[:, 4] - top[:, 2]
+    x, y = top[:, 2], top[:, 1] - h
+    regions = np.stack([x - 2 * h, y + 2 * h, x, y, x + 2 * h, y + 2 * h],
+                       axis=1)
+
+    back = np.array(_rgb(skin['back_color'](ml)), float)
+    area = 4 * h**2
+    colors = [np.zeros((len(regions), 3)) for _ in range(4)]
+    covered = np.zeros(len(regions))
+    for l in range(cut):
+        level = triangles[l]
+        inside = _ancestors(np.arange(len(level)), ml - 1 - l, ml - cut)
+        size = (level[:, 4] - level[:, 2])**2
+        covered += np.bincount(inside, size, len(regions))
+
+        palette = np.array([
+            _rgb(skin['neg_color'](l, ml)),
+            _rgb(skin['pos_color'](l, ml)),
+        ], float)
+        for quadrant in range(4):
+            shades = palette[(labels[quadrant][l] != '').astype(np.intp)]
+            for channel in range(3):
+                colors[quadrant][:, channel] += np.bincount(
+                    inside, size * shades[:, channel], len(regions))
+
+    for quadrant in range(4):
+        colors[quadrant] = np.round(
+            (colors[quadrant] + (area - covered)[:, None] * back) /
+            area[:, None]).astype(np.uint8)
+
+    empty = np.empty((0, 6))
+    return ([empty] * cut + triangles[cut:], [
+        [np.empty(0, object)] * cut + quadrant[cut:] for quadrant in labels
+    ], (regions, colors))
+
+
+def _hex(color):
+    return '#{:02x}{:02x}{:02x}'.format(*color)
+
+
+def _rgb(color):
+    return [int(color[i:i + 2], 16) for i in (1, 3, 5)]
+
+
+def _corners(p, q, g):
+    """Returns the corners of a triangle in the figure from those in the
+    top quadrant, turned to quadrant q and moved out by the gap g
 
-    # deep copy of fractal triangles with extra meta field(s)
-    labeled_fractals = [[[[z, ''] for z in y] for y in x] for x in fractals]
-    for level, names in enumerate(labels[:len(labeled_fractals[0])]):
-        for i, name in enumerate(names[:4 * len(labeled_fractals[0][level])]):
-            quadrant = i % 4
-            labeled_fractals[quadrant][level][int(i / 4)][1] = name
+    """
 
-    return labeled_fractals
+    return [
+        (((p[2 * k + 1] + g) if q % 2 else p[2 * k]) * (-1)**(q in [2, 3]),
+         (p[2 * k] if q % 2 else (p[2 * k + 1] + g)) * (-1)**(q in [1, 2]))
+        for k in range(3)
+    ]
 
 
 def create_figure(
-        fractals,
+        triangles,
+        labels,
         name,
         extension,
         blank,
@@ -135,9 +308,12 @@ def create_figure(
         pixels,
         skin,
         unlabeled_text=lambda l, ml: '',
+        detail=0,
 ):
     g = gap / 2
-    ml = len(fractals[0])
+    ml = len(triangles)
+    triangles, labels, regions = cull_figure(triangles, labels, pixels,
+                                             detail, skin)
 
     size = 2**(ml + 1) + g * 2 + padding
     d = draw.Drawing(size, size, origin='center')
@@ -149,25 +325,28 @@ def create_figure(
             size,
             fill=skin['back_color'](ml),
         ))
-    triangles = [y[0] for x in fractals[0] for y in x]
 
-    for quadrant, fractal in enumerate(fractals):
+    for quadrant in range(4):
         q = (quadrant + rotation) % 4
-        for l, triangles in enumerate(fractal):
-            for p, label in triangles:
+        if regions:
+            for p, color in zip(regions[0].tolist(),
+                                regions[1][quadrant].tolist()):
+                d.append(
+                    draw.Lines(
+                        *[c for corner in _corners(p, q, g) for c in corner],
+                        fill=_hex(color),
+                    ))
+
+        for l, level in enumerate(triangles):
+            for p, label in zip(level.tolist(), labels[quadrant][l]):
                 d.append(
                     draw.Lines(
-                        ((p[1] + g) if q % 2 else p[0]) * (-1)**(q in [2, 3]),
-                        (p[0] if q % 2 else (p[1] + g)) * (-1)**(q in [1, 2]),
-                        ((p[3] + g) if q % 2 else p[2]) * (-1)**(q in [2, 3]),
-                        (p[2] if q % 2 else (p[3] + g)) * (-1)**(q in [1, 2]),
-                        ((p[5] + g) if q % 2 else p[4]) * (-1)**(q in [2, 3]),
-                        (p[4] if q % 2 else (p[5] + g)) * (-1)**(q in [1, 2]),
+                        *[c for corner in _corners(p, q, g) for c in corner],
                         fill=skin['pos_color'](l, ml)
                         if label else skin['neg_color'](l, ml),
                     ))
 
-                if not blank:
+                if not blank and (2**l) / 8 * pixels >= detail:
                     d.append(
                         draw.Text(
                             label.upper() if label else unlabeled_text(l, ml),
@@ -182,7 +361,297 @@ def create_figure(
     getattr(d, EXTENSIONS[extension])('{}.{}'.format(name, extension))
 
 
-def render(data, levels, **kwargs):
+def create_merged_figure(
+        triangles,
+        labels,
+        name,
+        extension,
+        blank,
+        rotation,
+        padding,
+        gap,
+        pixels,
+        skin,
+        unlabeled_text=lambda l, ml: '',
+        detail=0,
+        chunk=2**16,
+):
+    """Writes the same figure as create_figure as SVG, but with all the
+    triangles of a level and color in one path and the colors as classes,
+    written a chunk of triangles at a time
+
+    """
+
+    assert extension == 'svg', 'Merged figures are only written as SVG'
+
+    g = gap / 2
+    ml = len(triangles)
+    triangles, labels, regions = cull_figure(triangles, labels, pixels,
+                                             detail, skin)
+    size = 2**(ml + 1) + g * 2 + padding
+
+    with open('{}.{}'.format(name, extension), 'w') as fd:
+        fd.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<svg xmlns="http://www.w3.org/2000/svg"'
+            ' width="{0}" height="{0}" viewBox="{1} {1} {2} {2}">\n'
+            '<style>\n'.format(size * pixels, -size / 2, size))
+        for l in range(ml):
+            fd.write('.p{0}{{fill:{1}}} .n{0}{{fill:{2}}}\n'.format(
+                l, skin['pos_color'](l, ml), skin['neg_color'](l, ml)))
+        fd.write('.t{{fill:{}}}\n</style>\n'.format(skin['text_color'](ml)))
+        fd.write('<rect x="{0}" y="{0}" width="{1}" height="{1}"'
+                 ' fill="{2}" />\n'.format(-size / 2, size,
+                                           skin['back_color'](ml)))
+
+        def path(shown, q):
+            # the quadrant's corner of the figure, with svg's y axis
+            # pointing down
+            xs, ys = shown[:, 0::2], shown[:, 1::2] + g
+            if q % 2:
+                xs, ys = ys, xs
+            xs = xs * (-1)**(q in [2, 3])
+            ys = ys * -(-1)**(q in [1, 2])
+            points = np.stack([xs, ys], axis=2).reshape(-1, 6)
+
+            # the first corner and then steps of the triangle's height,
+            # which coordinates of halves print exactly
+            points[:, 2:] -= points[:, :4].copy()
+
+            for start in range(0, len(points), chunk):
+                fd.write(''.join(
+                    'M{:.12g} {:.12g}l{:.12g} {:.12g}l{:.12g} {:.12g}z'.format(
+                        *p) for p in points[start:start + chunk].tolist()))
+
+        # regions of the same color share a path as well
+        if regions:
+            shades = np.concatenate(regions[1])
+            quadrants = np.repeat(np.arange(4), len(regions[0]))
+            for color in np.unique(shades, axis=0).tolist():
+                same = (shades == color).all(axis=1)
+                fd.write('<path fill="{}" d="'.format(_hex(color)))
+                for quadrant in range(4):
+                    path(
+                        regions[0][same[quadrants == quadrant]],
+                        (quadrant + rotation) % 4,
+                    )
+                fd.write('" />\n')
+
+        for l, level in enumerate(triangles):
+            if not len(level):
+                continue
+            for kind in ['p', 'n']:
+                fd.write('<path class="{}{}" d="'.format(kind, l))
+                for quadrant in range(4):
+                    labeled = labels[quadrant][l] != ''
+                    path(
+                        level[labeled if kind == 'p' else ~labeled],
+                        (quadrant + rotation) % 4,
+                    )
+                fd.write('" />\n')
+
+        if not blank:
+            for quadrant in range(4):
+                q = (quadrant + rotation) % 4
+                for l, level in enumerate(triangles):
+                    if not len(level) or (2**l) / 8 * pixels < detail:
+                        continue
+                    fd.write('<g class="t" font-size="{}"'
+                             ' transform="rotate({})">\n'.format(
+                                 (2**l) / 8, q * 90))
+                    unlabeled = html.escape(unlabeled_text(l, ml))
+                    x = (level[:, 0] + level[:, 4]) / 2 - (level[:, 4] -
+                                                           level[:, 0]) * 3 / 8
+                    y = -((level[:, 1] + level[:, 5]) / 2 + g + (2**l) / 32)
+                    for start in range(0, len(level), chunk):
+                        fd.write(''.join(
+                            '<text x="{}" y="{}">{}</text>\n'.format(
+                                tx, ty,
+                                html.escape(label.upper())
+                                if label else unlabeled)
+                            for tx, ty, label in zip(
+                                x[start:start + chunk].tolist(),
+                                y[start:start + chunk].tolist(),
+                                labels[quadrant][l][start:start + chunk])))
+                    fd.write('</g>\n')
+
+        fd.write('</svg>\n')
+
+
+def create_raster_figure(
+        triangles,
+        labels,
+        name,
+        extension,
+        blank,
+        rotation,
+        padding,
+        gap,
+        pixels,
+        skin,
+        unlabeled_text=lambda l, ml: '',
+        detail=0,
+        strip=256,
+):
+    """Draws the triangles of create_figure straight into a PNG, a strip
+    of rows at a time so that the whole image never has to be in memory
+
+    Every triangle is right-angled with its sides along the axes or
+    diagonal, so each row of pixels cuts it in one run that is found
+    arithmetically, and the work is in proportion to the pixels filled.
+    Labels aren't drawn; they can be laid over the image from the SVG.
+
+    """
+
+    assert extension == 'png', 'Raster figures are only written as PNG'
+
+    g = gap / 2
+    ml = len(triangles)
+    triangles, labels, regions = cull_figure(triangles, labels, pixels,
+                                             detail, skin)
+    size = 2**(ml + 1) + g * 2 + padding
+    width = int(round(size * pixels))
+
+    # row i's center is at y = size / 2 - (i + 0.5) / pixels and column
+    # j's at x = (j + 0.5) / pixels - size / 2
+    def rows(lower, upper):
+        return (np.ceil((size / 2 - upper) * pixels - 0.5).astype(np.int64),
+                np.floor((size / 2 - lower) * pixels - 0.5).astype(np.int64))
+
+    def columns(lower, upper):
+        return (np.ceil((lower + size / 2) * pixels - 0.5).astype(np.int64),
+                np.floor((upper + size / 2) * pixels - 0.5).astype(np.int64))
+
+    # the rows each triangle covers in the figure, drawn in the same order
+    # as create_figure and sorted by their first row
+    layers = []
+
+    def layer(q, shown, colors, palette):
+        if not len(shown):
+            return
+
+        # the x of the apex and of the middle of the base, which is w to
+        # either side of it, at the y of each
+        x, apex, base = shown[:, 2], shown[:, 3], shown[:, 1]
+        w = shown[:, 4] - shown[:, 2]
+
+        # the base is along the x axis of even quadrants and along the y
+        # axis of odd ones
+        sy = (-1)**(q in [1, 2])
+        if q % 2:
+            ends = sy * (x - w), sy * (x + w)
+        else:
+            ends = sy * (apex + g), sy * (base + g)
+        top, bottom = rows(np.minimum(*ends), np.maximum(*ends))
+        order = np.argsort(top, kind='stable')
+        layers.append((q, x[order], apex[order], base[order], w[order],
+                       top[order], bottom[order], colors[order], palette))
+
+    for quadrant in range(4):
+        q = (quadrant + rotation) % 4
+        if regions:
+            layer(q, regions[0], np.arange(len(regions[0])),
+                  regions[1][quadrant])
+        for l, level in enumerate(triangles):
+            layer(
+                q, level, (labels[quadrant][l] != '').astype(np.intp),
+                np.array([
+                    _rgb(skin['neg_color'](l, ml)),
+                    _rgb(skin['pos_color'](l, ml)),
+                ], np.uint8))
+
+    def chunk(kind, body):
+        return (struct.pack('>I', len(body)) + kind + body +
+                struct.pack('>I', zlib.crc32(kind + body)))
+
+    compressor = zlib.compressobj(6)
+    with open('{}.{}'.format(name, extension), 'wb') as fd:
+        fd.write(b'\x89PNG\r\n\x1a\n')
+        fd.write(
+            chunk(b'IHDR', struct.pack('>IIBBBBB', width, width, 8, 2, 0, 0,
+                                       0)))
+
+        for start in range(0, width, strip):
+            end = min(start + strip, width)
+            image = np.empty((end - start, width, 3), np.uint8)
+            image[:] = _rgb(skin['back_color'](ml))
+
+            for q, x, apex, base, w, top, bottom, colors, palette in layers:
+                sx, sy = (-1)**(q in [2, 3]), (-1)**(q in [1, 2])
+
+                # the triangles in the strip, none of which spans more
+                # rows than the largest of the layer
+                span = int((bottom - top).max())
+                k = np.arange(
+                    np.searchsorted(top, start - span, 'left'),
+                    np.searchsorted(top, end, 'left'),
+                )
+                k = k[bottom[k] >= start]
+
+                # one run of pixels for every row of every triangle
+                first = np.maximum(top[k], start)
+                count = np.maximum(np.minimum(bottom[k], end - 1) - first + 1,
+                                   0)
+                k = np.repeat(k, count)
+                row = np.repeat(first, count) + np.arange(
+                    len(k)) - np.repeat(np.cumsum(count) - count, count)
+                at = size / 2 - (row + 0.5) / pixels
+
+                # a triangle is 2 * w * t wide at t of the way from its
+                # apex to its base
+                if q % 2:
+                    inner = apex[k] + (base[k] - apex[k]) * np.abs(
+                        at * sy - x[k]) / w[k] + g
+                    lower = np.minimum(inner, base[k] + g)
+                    upper = np.maximum(inner, base[k] + g)
+                    if sx < 0:
+                        lower, upper = -upper, -lower
+                else:
+                    reach = w[k] * (at * sy - g - apex[k]) / (base[k] -
+                                                              apex[k])
+                    lower, upper = x[k] * sx - reach, x[k] * sx + reach
+                left, right = columns(lower, upper)
+                left, right = np.maximum(left, 0), np.minimum(right, width - 1)
+                count = np.maximum(right - left + 1, 0)
+
+                # and every pixel of the runs
+                owner = np.repeat(k, count)
+                image[np.repeat(row - start, count),
+                      np.repeat(left, count) + np.arange(len(owner)) -
+                      np.repeat(np.cumsum(count) - count, count)] = palette[
+                          colors[owner]]
+
+            # every row starts with the byte of its filter, here none
+            lines = np.zeros((end - start, 1 + 3 * width), np.uint8)
+            lines[:, 1:] = image.reshape(end - start, -1)
+            data = compressor.compress(lines.tobytes())
+            if data:
+                fd.write(chunk(b'IDAT', data))
+
+        fd.write(chunk(b'IDAT', compressor.flush()))
+        fd.write(chunk(b'IEND', b''))
+
+
+def tier_text(l, ml):
+    return '{:,} {}'.format(4**l, TIERS[l % len(TIERS)].upper())
+
+
+def draw_figure(triangles, labels, merge=False, direct=False, **kwargs):
+    """Draws the figure with create_figure, or for PNG output directly if
+    direct is set and for SVG output merged if merge is set
+
+    """
+
+    if direct and kwargs['extension'] == 'png':
+        create = create_raster_figure
+    elif merge and kwargs['extension'] == 'svg':
+        create = create_merged_figure
+    else:
+        create = create_figure
+    create(triangles, labels, unlabeled_text=tier_text, **kwargs)
+
+
+def render(data, levels, cache=None, **kwargs):
     """Render the fractal
 
     Parameters:
@@ -190,14 +659,60 @@ def render(data, levels, **kwargs):
 
     """
 
-    labels = create_labels(data)
-    fractals = create_fractals(labels, levels)
-    create_figure(
-        fractals,
-        unlabeled_text=
-        lambda l, ml: '{:,} {}'.format(4**l, TIERS[l % len(TIERS)].upper()),
-        **kwargs,
-    )
+    triangles, labels = create_fractals(create_labels(data), levels, cache)
+    draw_figure(triangles, labels, **kwargs)
+
+
+# the geometry and labels that the processes of render_variants share
+_shared = {}
+
+
+def _share(triangles, labels):
+    _shared['triangles'] = triangles
+    _shared['labels'] = labels
+
+
+def _draw_variant(options):
+    options = dict(options, skin=SKINS[options['skin']])
+    draw_figure(_shared['triangles'], _shared['labels'], **options)
+
+
+def render_variants(data,
+                    levels,
+                    matrix,
+                    workers=None,
+                    cache=None,
+                    **kwargs):
+    """Render every combination of the options in matrix, which maps
+    option names to lists of values, from one build of the labels and
+    triangles and on a pool of processes
+
+    The other options are those of render, except that skin is the name
+    of one of SKINS, and each output is named after the values of its
+    combination.
+
+    """
+
+    triangles, labels = create_fractals(create_labels(data), levels, cache)
+
+    variants = []
+    for values in itertools.product(*matrix.values()):
+        options = dict(kwargs, **dict(zip(matrix, values)))
+        parts = [options['name']]
+        for key, value in zip(matrix, values):
+            if key == 'extension':
+                continue
+            if type(value) == bool:
+                parts.append(key if value else 'no' + key)
+            else:
+                parts.append(str(value))
+        options['name'] = '-'.join(parts)
+        variants.append(options)
+
+    # forked processes inherit the geometry instead of unpickling it
+    with multiprocessing.Pool(workers, _share,
+                              (triangles, labels)) as pool:
+        pool.map(_draw_variant, variants, chunksize=1)
 
 
 if __name__ == '__main__':
@@ -280,6 +795,52 @@ if __name__ == '__main__':
         default='light',
     )
 
+    parser.add_argument(
+        '-m',
+        '--merge',
+        help='Write one SVG path per level and color (much smaller and faster)',
+        action='store_true',
+    )
+
+    parser.add_argument(
+        '-d',
+        '--direct',
+        help='Draw PNG output directly, a strip at a time and without labels',
+        action='store_true',
+    )
+
+    parser.add_argument(
+        '-t',
+        '--detail',
+        help='Leave out triangles and labels less than this many pixels high,'
+        ' and fill the regions of triangles too small to see with their'
+        ' average color',
+        type=float,
+        default=0,
+    )
+
+    parser.add_argument(
+        '-c',
+        '--cache',
+        help='Directory to keep the geometry of each size of fractal in,'
+        ' so that it is only built once',
+    )
+
+    parser.add_argument(
+        '-M',
+        '--matrix',
+        help='Path to JSON object of option names to lists of values, to'
+        ' render every combination of them at once',
+    )
+
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        help='Number of processes to render the combinations with (default'
+        ' all cores)',
+        type=int,
+    )
+
     args = parser.parse_args()
 
     with open(args.path) as fd:
@@ -288,15 +849,25 @@ if __name__ == '__main__':
     assert args.extension in EXTENSIONS, 'Extension not supported'
     assert args.skin in SKINS, 'Skin not found'
 
-    render(
-        data[:200],
+    options = dict(
         name=args.name,
         extension=args.extension,
-        levels=args.levels,
         blank=args.blank,
         rotation=args.rotation,
         gap=args.gap,
         padding=args.padding,
         pixels=args.pixels,
-        skin=SKINS[args.skin],
+        skin=args.skin,
+        merge=args.merge,
+        direct=args.direct,
+        detail=args.detail,
     )
+
+    if args.matrix:
+        with open(args.matrix) as fd:
+            matrix = json.load(fd)
+        render_variants(data, args.levels, matrix, args.jobs, args.cache,
+                        **options)
+    else:
+        render(data, args.levels, args.cache,
+               **dict(options, skin=SKINS[args.skin]))
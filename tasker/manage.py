@@ -1,7 +1,12 @@
 #!/usr/bin/python3
 
+import os
 import sys
 import json
+import fcntl
+import sqlite3
+import keyword
+import contextlib
 import argparse
 import textwrap
 
@@ -9,6 +14,281 @@ from collections import OrderedDict
 from datetime import datetime, date, timedelta
 
 
+RECORD = 'record.json'
+DATABASE = 'record.db'
+
+FIELDS = ['name', 'brief', 'start', 'target', 'debrief', 'end']
+
+# commands that never change the records
+READ_ONLY = ['view', 'list']
+
+
+class JsonStore:
+    """Keeps the records in one JSON file, which is read whole when opened
+    and, if opened to write, written whole when closed
+
+    Writers hold a lock on a file next to it from reading to writing, so
+    that they take turns, and replace the file with a complete new one, so
+    that readers never need the lock and never see half of one.
+
+    """
+
+    def __init__(self, path=RECORD, write=False):
+        self._path = path
+        self._lock = None
+        if write:
+            self._lock = open(path + '.lock', 'a')
+            fcntl.flock(self._lock, fcntl.LOCK_EX)
+
+        with open(path) as fd:
+            self._data = json.load(fd, object_pairs_hook=OrderedDict)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # the lock is held from opening to closing already
+        yield
+
+    def info(self, volunteer):
+        return self._data[volunteer]['info']
+
+    def position(self, volunteer, index):
+        return range(len(self._data[volunteer]['tasks']))[index]
+
+    def task(self, volunteer, index):
+        return self._data[volunteer]['tasks'][index]
+
+    def tasks(self, volunteer):
+        return self._data[volunteer]['tasks']
+
+    def append(self, volunteer, task):
+        self._data[volunteer]['tasks'].append(task)
+        return len(self._data[volunteer]['tasks']) - 1
+
+    def update(self, volunteer, index, task):
+        self._data[volunteer]['tasks'][index] = task
+
+    def delete(self, volunteer, index):
+        del self._data[volunteer]['tasks'][index]
+
+    def dump(self):
+        return self._data
+
+    def close(self):
+        if not self._lock:
+            return
+
+        temporary = '{}.{}.tmp'.format(self._path, os.getpid())
+        with open(temporary, 'w') as fd:
+            json.dump(self._data, fd, indent=2)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(temporary, self._path)
+
+        self._lock.close()
+        self._lock = None
+
+
+class SqliteStore:
+    """Keeps the records in an SQLite database, indexed by volunteer,
+    status and dates, so that a command only reads the rows it needs
+
+    Tasks keep their place in their volunteer's list as a position, which
+    is what the task indices of the commands refer to. Every change is one
+    transaction that takes the write lock up front, or part of the one
+    that a command holds around reading and writing back a task. Readers
+    open the database read only, which in WAL mode doesn't wait on
+    writers.
+
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS volunteers (
+            id TEXT PRIMARY KEY,
+            position INTEGER NOT NULL,
+            info TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS tasks (
+            volunteer TEXT NOT NULL REFERENCES volunteers (id),
+            position INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            brief TEXT NOT NULL,
+            start TEXT NOT NULL,
+            target TEXT NOT NULL,
+            debrief TEXT NOT NULL,
+            "end" TEXT NOT NULL,
+            PRIMARY KEY (volunteer, position)
+        );
+        CREATE INDEX IF NOT EXISTS tasks_status ON tasks ("end" = '');
+        CREATE INDEX IF NOT EXISTS tasks_start ON tasks (start);
+        CREATE INDEX IF NOT EXISTS tasks_target ON tasks (target);
+        CREATE INDEX IF NOT EXISTS tasks_end ON tasks ("end");
+    '''
+
+    COLUMNS = ', '.join('"{}"'.format(f) for f in FIELDS)
+
+    def __init__(self, path=DATABASE, write=True):
+        self._write = write
+        if write:
+            self._db = sqlite3.connect(path, timeout=60, isolation_level=None)
+            self._db.execute('PRAGMA journal_mode = WAL')
+            self._db.executescript(self.SCHEMA)
+        else:
+            self._db = sqlite3.connect(
+                'file:{}?mode=ro'.format(path),
+                timeout=60,
+                uri=True,
+                isolation_level=None,
+            )
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Runs the body as one transaction, which takes the write lock up
+        front if the store is open to write, or as part of the transaction
+        already open
+
+        """
+
+        if self._db.in_transaction:
+            yield
+            return
+
+        self._db.execute('BEGIN IMMEDIATE' if self._write else 'BEGIN')
+        try:
+            yield
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+        self._db.execute('COMMIT')
+
+    def info(self, volunteer):
+        row = self._db.execute(
+            'SELECT info FROM volunteers WHERE id = ?',
+            (volunteer, ),
+        ).fetchone()
+        if row is None:
+            raise KeyError(volunteer)
+        return json.loads(row[0], object_pairs_hook=OrderedDict)
+
+    def position(self, volunteer, index):
+        """Returns the position of the task at index, which like a list
+        index counts from the end if it is negative
+
+        """
+
+        count = self._db.execute(
+            'SELECT COUNT(*) FROM tasks WHERE volunteer = ?',
+            (volunteer, ),
+        ).fetchone()[0]
+        if not count:
+            self.info(volunteer)
+        if not -count <= index < count:
+            raise IndexError('task index out of range')
+        return index + count if index < 0 else index
+
+    def task(self, volunteer, index):
+        row = self._db.execute(
+            'SELECT {} FROM tasks WHERE volunteer = ? AND position = ?'.format(
+                self.COLUMNS),
+            (volunteer, self.position(volunteer, index)),
+        ).fetchone()
+        return OrderedDict(zip(FIELDS, row))
+
+    def tasks(self, volunteer):
+        rows = self._db.execute(
+            'SELECT {} FROM tasks WHERE volunteer = ? ORDER BY position'.format(
+                self.COLUMNS),
+            (volunteer, ),
+        ).fetchall()
+        if not rows:
+            self.info(volunteer)
+        return [OrderedDict(zip(FIELDS, row)) for row in rows]
+
+    def append(self, volunteer, task):
+        with self.transaction():
+            self.info(volunteer)
+            index = self._db.execute(
+                'SELECT COUNT(*) FROM tasks WHERE volunteer = ?',
+                (volunteer, ),
+            ).fetchone()[0]
+            self._db.execute(
+                'INSERT INTO tasks VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [volunteer, index] + [task[f] for f in FIELDS],
+            )
+        return index
+
+    def update(self, volunteer, index, task):
+        with self.transaction():
+            self._db.execute(
+                'UPDATE tasks SET {} WHERE volunteer = ? AND position = ?'.
+                format(', '.join('"{}" = ?'.format(f) for f in FIELDS)),
+                [task[f] for f in FIELDS] +
+                [volunteer, self.position(volunteer, index)],
+            )
+
+    def delete(self, volunteer, index):
+        with self.transaction():
+            position = self.position(volunteer, index)
+            self._db.execute(
+                'DELETE FROM tasks WHERE volunteer = ? AND position = ?',
+                (volunteer, position),
+            )
+            self._db.execute(
+                'UPDATE tasks SET position = position - 1'
+                ' WHERE volunteer = ? AND position > ?',
+                (volunteer, position),
+            )
+
+    def load(self, data):
+        """Replaces the records with those of data, in the layout of
+        record.json
+
+        """
+
+        with self.transaction():
+            self._db.execute('DELETE FROM tasks')
+            self._db.execute('DELETE FROM volunteers')
+            for position, (volunteer, record) in enumerate(data.items()):
+                self._db.execute(
+                    'INSERT INTO volunteers VALUES (?, ?, ?)',
+                    (volunteer, position, json.dumps(record['info'])),
+                )
+                self._db.executemany(
+                    'INSERT INTO tasks VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    [[volunteer, i] + [task[f] for f in FIELDS]
+                     for i, task in enumerate(record['tasks'])],
+                )
+
+    def dump(self):
+        """Returns all the records in the layout of record.json"""
+
+        data = OrderedDict()
+        for volunteer, info in self._db.execute(
+                'SELECT id, info FROM volunteers ORDER BY position'):
+            data[volunteer] = OrderedDict([
+                ('info', json.loads(info, object_pairs_hook=OrderedDict)),
+                ('tasks', []),
+            ])
+        for row in self._db.execute(
+                'SELECT volunteer, {} FROM tasks'
+                ' ORDER BY volunteer, position'.format(self.COLUMNS)):
+            data[row[0]]['tasks'].append(OrderedDict(zip(FIELDS, row[1:])))
+        return data
+
+    def close(self):
+        self._db.close()
+
+
+def open_store(write=True):
+    """Returns the database store once there is one, or else the one of
+    record.json, opened to write unless told otherwise
+
+    """
+
+    if os.path.exists(DATABASE):
+        return SqliteStore(DATABASE, write)
+    return JsonStore(RECORD, write)
+
+
 class Manage:
     def __init__(self):
         parser = argparse.ArgumentParser(
@@ -21,23 +301,33 @@ class Manage:
             open      reopen a task
             edit      edit a task
             delete    delete task
+            import    move record.json into the database
+            export    write the database out to record.json
             ''',
         )
         parser.add_argument('command', help='subcommand to run')
         args = parser.parse_args(sys.argv[1:2])
 
-        if not hasattr(self, args.command):
+        # commands that are keywords have an underscore after them
+        command = args.command
+        if keyword.iskeyword(command):
+            command += '_'
+
+        if command.startswith('_') or not hasattr(self, command):
             print('Command not found')
             parser.print_help()
             exit(1)
 
-        with open('record.json') as fd:
-            self._data = json.load(fd, object_pairs_hook=OrderedDict)
+        if command in ['import_', 'export']:
+            getattr(self, command)()
+            return
 
-        getattr(self, args.command)()
-
-        with open('record.json', 'w') as fd:
-            json.dump(self._data, fd, indent=2)
+        # a command reads and writes back its task in one go, so that
+        # concurrent commands never undo each other's changes
+        self._store = open_store(write=command not in READ_ONLY)
+        with self._store.transaction():
+            getattr(self, command)()
+        self._store.close()
 
     def view(self):
         parser = argparse.ArgumentParser()
@@ -45,7 +335,7 @@ class Manage:
         parser.add_argument('index', type=int, help='task index')
         args = parser.parse_args(sys.argv[2:])
 
-        task = self._data[args.volunteer]['tasks'][args.index]
+        task = self._store.task(args.volunteer, args.index)
 
         self._print_task(args.volunteer, args.index, task)
 
@@ -58,7 +348,7 @@ class Manage:
         print(
             '------------------------------------------------------------------------'
         )
-        for i, task in enumerate(self._data[args.volunteer]['tasks']):
+        for i, task in enumerate(self._store.tasks(args.volunteer)):
             print('{} (id: {}, started: {}, {})'.format(
                 task['name'],
                 i,
@@ -94,8 +384,7 @@ class Manage:
         task['debrief'] = ''
         task['end'] = ''
 
-        self._data[args.volunteer]['tasks'].append(task)
-        index = len(self._data[args.volunteer]['tasks']) - 1
+        index = self._store.append(args.volunteer, task)
 
         print('\nCreated Task')
         self._print_task(args.volunteer, index, task)
@@ -112,11 +401,12 @@ class Manage:
         )
         args = parser.parse_args(sys.argv[2:])
 
-        task = self._data[args.volunteer]['tasks'][args.index]
+        task = self._store.task(args.volunteer, args.index)
 
         task['debrief'] = args.debrief
         task['end'] = str(date.today() +
                           timedelta(args.end if args.end else 0))
+        self._store.update(args.volunteer, args.index, task)
 
         print('\nTask Closed')
         self._print_task(args.volunteer, args.index, task)
@@ -127,10 +417,11 @@ class Manage:
         parser.add_argument('index', type=int, help='task index')
         args = parser.parse_args(sys.argv[2:])
 
-        task = self._data[args.volunteer]['tasks'][args.index]
+        task = self._store.task(args.volunteer, args.index)
 
         task['debrief'] = ''
         task['end'] = ''
+        self._store.update(args.volunteer, args.index, task)
 
         print('\nTask Opened')
         self._print_task(args.volunteer, args.index, task)
@@ -179,12 +470,9 @@ class Manage:
         )
         args = parser.parse_args(sys.argv[2:])
 
-        task = self._data[args.volunteer]['tasks'][args.index]
+        task = self._store.task(args.volunteer, args.index)
         today = date.today()
 
-        if args.reassignment:
-            self._data[args.volunteer]['tasks'].append(task)
-            del self._data[args.volunteer]['tasks'][args.index]
         if args.name:
             task['name'] = args.name
         if args.brief:
@@ -198,6 +486,16 @@ class Manage:
         if args.end:
             task['end'] = str(today + timedelta(args.close))
 
+        if args.reassignment:
+            # counted before the copy is added, which a negative index
+            # would otherwise refer to
+            with self._store.transaction():
+                index = self._store.position(args.volunteer, args.index)
+                self._store.append(args.volunteer, task)
+                self._store.delete(args.volunteer, index)
+        else:
+            self._store.update(args.volunteer, args.index, task)
+
         print('\nEdited Task')
         self._print_task(args.volunteer, args.index, task)
 
@@ -207,18 +505,64 @@ class Manage:
         parser.add_argument('index', type=int, help='task index')
         args = parser.parse_args(sys.argv[2:])
 
-        task = self._data[args.volunteer]['tasks'][args.index]
-        del self._data[args.volunteer]['tasks'][args.index]
+        task = self._store.task(args.volunteer, args.index)
+        self._store.delete(args.volunteer, args.index)
 
         print('\nDeleted Task')
         self._print_task(args.volunteer, args.index, task)
 
+    def import_(self):
+        parser = argparse.ArgumentParser()
+        parser.add_argument(
+            'path',
+            nargs='?',
+            default=RECORD,
+            help='records in the layout of record.json',
+        )
+        args = parser.parse_args(sys.argv[2:])
+
+        with open(args.path) as fd:
+            data = json.load(fd, object_pairs_hook=OrderedDict)
+
+        store = SqliteStore(DATABASE)
+        store.load(data)
+        store.close()
+
+        print('\nImported {} volunteers into {}\n'.format(
+            len(data), DATABASE))
+
+    def export(self):
+        parser = argparse.ArgumentParser()
+        parser.add_argument(
+            'path',
+            nargs='?',
+            default=RECORD,
+            help='file to write the records to',
+        )
+        args = parser.parse_args(sys.argv[2:])
+
+        if not os.path.exists(DATABASE):
+            print('No database to export')
+            exit(1)
+
+        store = SqliteStore(DATABASE, write=False)
+        data = store.dump()
+        store.close()
+
+        # written whole and then moved into place, for display.py
+        temporary = '{}.{}.tmp'.format(args.path, os.getpid())
+        with open(temporary, 'w') as fd:
+            json.dump(data, fd, indent=2)
+        os.replace(temporary, args.path)
+
+        print('\nExported {} volunteers to {}\n'.format(len(data), args.path))
+
     def _print_task(self, volunteer, index, task):
         print(
             '\n------------------------------------------------------------------------'
         )
         print('Volunteer: {}'.format(
-            self._data[volunteer]['info']['nick_name']))
+            self._store.info(volunteer)['nick_name']))
         print('Task #:    {}'.format(index))
         print('Name:      {}'.format(task['name']))
         print('Projected: {} to {}'.format(task['start'], task['target']))